@@ -0,0 +1,151 @@
+# Copyright 2020 Lin Wang
+
+# This code is part of the Advanced Computer Networks (2020) course at Vrije
+# Universiteit Amsterdam.
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+#!/usr/bin/env python3
+
+# Micro-benchmarks for the graph algorithms of topo.py
+
+import sys
+import time
+import tracemalloc
+
+import topo
+
+# Sizes (number of switches) of the Jellyfish instances to benchmark
+SIZES = [100, 1000, 5000]
+PORTS = 12
+
+# Instances whose build time and memory are measured
+MEMORY_TOPOLOGIES = [
+	("Jellyfish(20000, 10000, 12)", lambda: topo.Jellyfish(20000, 10000, 12, seed=0)),
+	("Fattree(32)", lambda: topo.Fattree(32)),
+]
+
+# The legacy pair loop runs a list based BFS per server, keep it small
+PAIR_SIZES = [100, 250]
+
+#the list based BFS that Jellyfish.shortest_path2 used before topo.Graph.bfs
+def legacy_shortest_path2(jf, src):
+	dst=[-1]*len(jf.switches)
+	prec=[None]*len(jf.switches)
+	explored=[]
+	queue=[]
+	dst[int(src.id)]=0
+	queue.append(src)
+	queue.append(0)
+	while queue :
+		node=queue.pop(0)
+		dist=queue.pop(0)
+
+		if node not in explored:
+			for edge in node.edges:
+
+				if edge.lnode==node:
+					to_node=edge.rnode
+				else:
+					to_node=edge.lnode
+
+				if to_node.type=="switch":
+					if dst[int(to_node.id)]==-1:
+						dst[int(to_node.id)]=dist+1
+						prec[int(to_node.id)]=node.id
+						queue.append(to_node)
+						queue.append(dist+1)
+
+			explored.append(node)
+
+	return dst,prec
+
+#the per-server-pair loop that Jellyfish.get_server_pairs used before
+#the batched all-pairs switch distances
+def legacy_get_server_pairs(jf):
+	count=[0]*5
+	for i in range(0,len(jf.servers)):
+		sw_i=jf.server_switch(jf.servers[i])
+		dst_arr=legacy_shortest_path2(jf, sw_i)[0]
+		for k in range(i+1,len(jf.servers)):
+			sw_k=jf.server_switch(jf.servers[k])
+			hop=dst_arr[int(sw_k.id)]+2
+			if 2<=hop<=6:
+				count[hop-2]+=1
+	return count
+
+def timed(fn, *args):
+	start = time.perf_counter()
+	result = fn(*args)
+	return result, time.perf_counter() - start
+
+def bench_generate():
+	print("Jellyfish generation")
+	print("%8s %12s %10s" % ("switches", "time [s]", "unmatched"))
+	for n in SIZES + [10000]:
+		jf, t = timed(topo.Jellyfish, 2 * n, n, PORTS, n)
+		if jf.unmatched_pairs():
+			sys.exit("free ports left between non-adjacent switches at %d switches" % n)
+		print("%8d %12.4f %10d" % (n, t, jf.unmatched_ports))
+
+#build time, then memory held by the topology once built and peak memory
+#during the build, as traced by tracemalloc (which slows the build down,
+#hence the separate untraced run)
+def bench_memory():
+	print("Topology build time and memory")
+	print("%-28s %10s %12s %12s" % ("topology", "time [s]", "memory [MB]", "peak [MB]"))
+	for name, build in MEMORY_TOPOLOGIES:
+		net, t = timed(build)
+		del net
+		tracemalloc.start()
+		net = build()
+		current, peak = tracemalloc.get_traced_memory()
+		tracemalloc.stop()
+		print("%-28s %10.4f %12.2f %12.2f" % (name, t, current / 1e6, peak / 1e6))
+
+def bench_bfs(sources=5):
+	print("BFS from %d sources (legacy list BFS vs topo.Graph.bfs)" % sources)
+	print("%8s %12s %12s %9s" % ("switches", "legacy [s]", "new [s]", "speedup"))
+	for n in SIZES:
+		jf = topo.Jellyfish(2 * n, n, PORTS, seed=n)
+		legacy = new = 0.0
+		for src in jf.rng.sample(jf.switches, sources):
+			old_res, t_old = timed(legacy_shortest_path2, jf, src)
+			new_res, t_new = timed(jf.shortest_path2, src)
+			if old_res != new_res:
+				sys.exit("shortest_path2 mismatch at %d switches" % n)
+			legacy += t_old
+			new += t_new
+		print("%8d %12.4f %12.4f %8.1fx" % (n, legacy, new, legacy / new))
+
+def bench_server_pairs():
+	print("Server pair path lengths (legacy pair loop vs batched BFS)")
+	print("%8s %8s %12s %12s" % ("switches", "servers", "legacy [s]", "new [s]"))
+	for n in PAIR_SIZES:
+		jf = topo.Jellyfish(2 * n, n, PORTS, seed=n)
+		old_res, t_old = timed(legacy_get_server_pairs, jf)
+		new_res, t_new = timed(jf.get_server_pairs)
+		if old_res != new_res:
+			sys.exit("get_server_pairs mismatch at %d switches" % n)
+		print("%8d %8d %12.4f %12.4f" % (n, 2 * n, t_old, t_new))
+
+	#large instance, new engine only
+	jf = topo.Jellyfish(50000, 12500, 16, seed=0)
+	new_res, t_new = timed(jf.get_server_pairs)
+	print("%8d %8d %12s %12.4f" % (12500, 50000, "-", t_new))
+
+if __name__ == "__main__":
+	bench_generate()
+	bench_memory()
+	bench_bfs()
+	bench_server_pairs()
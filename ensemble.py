@@ -0,0 +1,90 @@
+# Copyright 2020 Lin Wang
+
+# This code is part of the Advanced Computer Networks (2020) course at Vrije
+# Universiteit Amsterdam.
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+#!/usr/bin/env python3
+
+# Generate and analyse many seeded Jellyfish instances across a process pool
+
+import argparse
+import json
+import math
+from multiprocessing import Pool
+
+import topo
+
+#build one seeded instance and return its path length statistics
+def analyse_instance(args):
+	num_servers, num_switches, num_ports, seed = args
+	jf = topo.Jellyfish(num_servers, num_switches, num_ports, seed=seed)
+	hist = jf.path_length_histogram()
+	pairs = sum(hist.values())
+	mean = sum(hops * n for hops, n in hist.items()) / pairs if pairs else 0.0
+	return {
+		"seed": seed,
+		"histogram": hist,
+		"mean_path_length": mean,
+		"diameter": len(jf.switch_distances()) - 1,
+	}
+
+def mean_std(values):
+	mean = sum(values) / len(values)
+	var = sum((v - mean) ** 2 for v in values) / len(values)
+	return mean, math.sqrt(var)
+
+#aggregate the statistics of the instances of an ensemble
+def aggregate(results):
+	hops = sorted(set(h for r in results for h in r["histogram"]))
+	histogram = {}
+	for h in hops:
+		mean, std = mean_std([r["histogram"].get(h, 0) for r in results])
+		histogram[h] = {"mean": mean, "std": std}
+	mean_path, std_path = mean_std([r["mean_path_length"] for r in results])
+	diameters = [r["diameter"] for r in results]
+	return {
+		"instances": len(results),
+		"histogram": histogram,
+		"mean_path_length": {"mean": mean_path, "std": std_path},
+		"diameter": {
+			"min": min(diameters),
+			"max": max(diameters),
+			"mean": sum(diameters) / len(diameters),
+			"counts": {d: diameters.count(d) for d in sorted(set(diameters))},
+		},
+	}
+
+#generate and analyse one Jellyfish instance per seed on a pool of
+#processes (one per core by default) and return the aggregated statistics
+def run_ensemble(num_servers, num_switches, num_ports, seeds, processes=None):
+	jobs = [(num_servers, num_switches, num_ports, seed) for seed in seeds]
+	with Pool(processes) as pool:
+		results = list(pool.imap_unordered(analyse_instance, jobs, chunksize=1))
+	results.sort(key=lambda r: r["seed"])
+	return aggregate(results), results
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Jellyfish ensemble statistics")
+	parser.add_argument("--servers", type=int, default=686)
+	parser.add_argument("--switches", type=int, default=245)
+	parser.add_argument("--ports", type=int, default=14)
+	parser.add_argument("--seeds", type=int, default=100,
+	                    help="number of instances, seeded 0..seeds-1")
+	parser.add_argument("--processes", type=int, default=None)
+	args = parser.parse_args()
+
+	summary, _ = run_ensemble(args.servers, args.switches, args.ports,
+	                          range(args.seeds), args.processes)
+	print(json.dumps(summary, indent=2))
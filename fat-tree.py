@@ -17,8 +17,13 @@
 
 # A dirty workaround to import topo.py from lab2
 
+import argparse
+import json
+import math
 import os
+import random
 import subprocess
+import sys
 import time
 import mininet
 import mininet.clean
@@ -34,158 +39,94 @@ import topo
 
 class FattreeNet(Topo):
 
-	def __init__(self, k):
+	# Mininet network of the k-ary fat-tree of topo.Fattree. Switch names
+	# (and so datapath ids) come from topo.Fattree.switch_name, hosts get
+	# the 10.pod.switch.id addresses of its servers, and the links are
+	# added in the order that gives the port numbers of topo.Fattree
+	def __init__(self, k, bw=15, delay='5ms'):
+		if k<2 or k%2:
+			raise ValueError("k must be a positive even number, not %s" % k)
 		self.pod=k
-		self.core_switches=(k/2)**2
-		self.agg_switches=k*k/2
-		self.edge_switches=k*k/2
-		self.host=k**3/4
-		self.host_pod=self.host/self.edge_switches
+		self.bw=bw
+		self.delay=delay
+		self.topo_net=topo.Fattree(k)
 		self.core_list=[]
 		self.agg_list=[]
 		self.edge_list=[]
 		self.server_list=[]
+		self.roles={}		#dpid->(role,pod,position)
+		self.names={}		#(role,pod,position)->switch name
 
 		Topo.__init__(self)
 
 
 	def create_switches(self):
-		self.create_core_switches(self.core_switches)
-		self.create_agg_switches(self.agg_switches)
-		self.create_edge_switches(self.edge_switches)
+		lists={"core":self.core_list,"aggregation":self.agg_list,"edge":self.edge_list}
+		for sw in self.topo_net.switches:
+			role=self.topo_net.switch_role(sw.index)
+			name=self.topo_net.switch_name(sw.index)
+			lists[role[0]].append(self.addSwitch(name, cls=OVSKernelSwitch))
+			self.roles[int(name)]=role
+			self.names[role]=name
 
 	def create_servers(self):
+		for i,server in enumerate(self.topo_net.servers):
+			self.server_list.append(self.addHost("server"+str(i),ip=server.id))
 
-
-		pod=0
-		switch=0
-		cont_switch=0
-		cont_pod=0
-		cont_server=1
-
-		for i in range(0,int(self.host)):
-			
-			if(cont_switch==2):
-				switch+=1
-				cont_switch=0
-
-			if(cont_pod==4):
-				switch=0
-				pod+=1
-				cont_pod=0
-
-			if(cont_server==3):
-				cont_server=1
-
-
-			ip="10."+str(pod)+"."+str(switch)+"."+str(cont_server)
-			self.server_list.append(self.addHost("server"+str(i),ip=ip))
-
-			cont_pod+=1
-			cont_server+=1
-			cont_switch+=1
-	
-	def create_core_switches(self, PREFIX):
-		self.add_switch(int(self.core_switches), "1", self.core_list)
-
-	def create_agg_switches(self, NUMBER):
-		self.add_switch(int(self.agg_switches), "2", self.agg_list)
-
-	def create_edge_switches(self, NUMBER):
-		self.add_switch(int(self.edge_switches), "3", self.edge_list)
-		 
-
-	def add_switch(self, number, prefix, switch_list):
-
-		if prefix=="1":
-			ip_base="10."+str(self.pod)
-
-			for i in range(0, int(number/2)):
-				ip=ip_base+".1."+str(i+1)
-				switch_list.append(self.addSwitch(prefix + str(i), cls=OVSKernelSwitch,ip=ip))
-
-			for i in range(int(number/2),number):
-				ip=ip_base+".1."+str(number/2+i)
-				switch_list.append(self.addSwitch(prefix + str(i), cls=OVSKernelSwitch,ip=ip))
-
-		
-		elif prefix=="2":
-
-			for i in range(0,number):
-				switch_list.append(self.addSwitch(prefix + str(i), cls=OVSKernelSwitch))
-		
-		elif prefix=="3":
-			for i in range(0,number):
-				switch_list.append(self.addSwitch(prefix + str(i), cls=OVSKernelSwitch))
-		
-		else:
-			return
+	def link(self, node1, node2):
+		self.addLink(node1, node2, bw=self.bw, delay=self.delay)
 
 	def connect_network(self):
-		#core-agg
-		print("CORE AGG")
-		end = int(self.pod/2)
-		for x in range(0, int(self.agg_switches), end):
-			for i in range(0, end):
-				for j in range(0, end):
-					print("Connecting core ",(i*end+j)," to agg", (x+i))
-					self.addLink(
-						self.core_list[i*end+j],
-						self.agg_list[x+i],
-						bw=15,
-						delay='5ms'
-						)   # use_htb=False
+		half=self.pod//2
+		#core-agg, every core switch sees the pods in order and every
+		#aggregation switch its core switches in order
+		for pod in range(self.pod):
+			for a in range(half):
+				for i in range(half):
+					self.link(self.names[("core",None,a*half+i)],
+					          self.names[("aggregation",pod,a)])
 
 		# Agg to Edge
-		for x in range(0, int(self.agg_switches),end):
-			for i in range(0, end):
-				for j in range(0, end):
-					self.addLink(
-						self.agg_list[x+i], self.edge_list[x+j], bw=15, delay='5ms')   
-
-		# Edge to Host
-		for x in range(0, int(self.edge_switches)):
-			for i in range(0, int(self.host_pod)):
-				self.addLink(
-					self.edge_list[x],
-					self.server_list[int(self.host_pod) * x + i],
-					bw=15,
-					delay='5ms')  
+		for pod in range(self.pod):
+			for a in range(half):
+				for e in range(half):
+					self.link(self.names[("aggregation",pod,a)],
+					          self.names[("edge",pod,e)])
+
+		# Edge to Host, in the order of topo.Fattree.servers
+		for i,host in enumerate(self.server_list):
+			pod,rest=divmod(i,half*half)
+			self.link(self.names[("edge",pod,rest//half)], host)
 
+	#role, pod and position of a switch given its dpid or name
+	def role(self, dpid):
+		return self.roles.get(int(dpid))
 
 	def is_core(self, dpid):
-		if dpid in self.core_list:
-			return True
-		else:
-			return False
+		role=self.role(dpid)
+		return role is not None and role[0]=="core"
 
 	def is_pod(self, dpid):
+		role=self.role(dpid)
+		return role is not None and role[0]!="core"
 
-		if dpid in self.agg_list:
-			return True
-		elif dpid in self.edge_list:
-			return True
-		else:
-			return False
-
-def make_mininet_instance(graph_topo):
+def make_mininet_instance(k, bw=15, delay='5ms'):
 
-	net_topo = FattreeNet(graph_topo)
+	net_topo = FattreeNet(k, bw, delay)
 	net_topo.create_switches()
 	net_topo.create_servers()
 	net_topo.connect_network()
-	print(net_topo.is_pod("34"))
-	net = Mininet(topo=net_topo, controller=None, autoSetMacs=True)
+	net = Mininet(topo=net_topo, controller=None, link=TCLink, autoSetMacs=True)
 	
 	net.addController('c0', controller=RemoteController, ip="127.0.0.1", port=6653)
 	return net
 
-def run(graph_topo):
+def run(k, bw=15, delay='5ms'):
 	
 	# Run the Mininet CLI with a given topology
 	lg.setLogLevel('info')
 	mininet.clean.cleanup()
-	net = make_mininet_instance(graph_topo)
+	net = make_mininet_instance(k, bw, delay)
 
 	info('*** Starting network ***\n')
 	net.start()
@@ -196,5 +137,287 @@ def run(graph_topo):
 
 
 
-#ft_topo = topo.Fattree(4)
-run(4)
\ No newline at end of file
+# Controllers compared by the ECMP benchmark: (ryu app, environment)
+ECMP_CONTROLLERS = [
+	("sp_routing.py", {"SP_ECMP": "0"}),
+	("sp_routing.py", {"SP_ECMP": "1"}),
+	("ft_routing.py", {"FT_ECMP": "0"}),
+	("ft_routing.py", {"FT_ECMP": "1"}),
+]
+
+def start_controller(app, env, k=4):
+	# Start a ryu controller in the background with extra environment,
+	# telling the controllers the size of the fat-tree
+	full_env = dict(os.environ)
+	full_env.update({"FT_K": str(k), "SP_FATTREE_K": str(k)})
+	full_env.update(env)
+	proc = subprocess.Popen(["ryu-manager", "--observe-links", app],
+	                        env=full_env, stdout=subprocess.DEVNULL,
+	                        stderr=subprocess.DEVNULL)
+	time.sleep(3)
+	return proc
+
+def stride_pairs(hosts, stride):
+	# host i sends to host (i + stride) mod n
+	return [(hosts[i], hosts[(i + stride) % len(hosts)]) for i in range(len(hosts))]
+
+def run_iperf(pairs, client_args):
+	# Run one TCP iperf flow per (src, dst) pair at the same time and
+	# return the fields of the final CSV report of every flow (None for
+	# a flow that failed)
+	for dst in set(dst for _, dst in pairs):
+		dst.cmd("iperf -s -D")
+	clients = [src.popen(["iperf", "-c", dst.IP(), "-y", "C"] + client_args)
+	           for src, dst in pairs]
+	reports = []
+	for client in clients:
+		out, _ = client.communicate()
+		lines = out.decode().strip().splitlines()
+		reports.append(lines[-1].split(",") if lines else None)
+	for dst in set(dst for _, dst in pairs):
+		dst.cmd("pkill -f 'iperf -s'")
+	return reports
+
+def iperf_pairs(net, pairs, duration):
+	# throughput of every flow in Mbit/s
+	reports = run_iperf(pairs, ["-t", str(duration)])
+	return [int(r[-1]) / 1e6 if r else 0.0 for r in reports]
+
+def fct_pairs(pairs, size):
+	# completion time in seconds of a size bytes transfer per pair, the
+	# end of the interval of its iperf report
+	reports = run_iperf(pairs, ["-n", str(size)])
+	return [float(r[6].split("-")[1]) if r else None for r in reports]
+
+def ping_pairs(pairs, count=20, interval=0.2):
+	# round trip times in ms of count pings per pair, all pairs at once
+	pings = [src.popen(["ping", "-i", str(interval), "-c", str(count), dst.IP()])
+	         for src, dst in pairs]
+	rtts = []
+	for ping in pings:
+		out, _ = ping.communicate()
+		for line in out.decode().splitlines():
+			if "time=" in line:
+				rtts.append(float(line.split("time=")[1].split()[0]))
+	return rtts
+
+def bench_ecmp(k, duration=10, bw=15, delay='5ms'):
+	# Aggregate stride throughput with single-path and ECMP routing
+	lg.setLogLevel('warning')
+	results = []
+	for app, env in ECMP_CONTROLLERS:
+		mininet.clean.cleanup()
+		controller = start_controller(app, env, k)
+		net = make_mininet_instance(k, bw, delay)
+		try:
+			net.start()
+			net.waitConnected()
+			net.pingAll()
+			hosts = net.hosts
+			rates = iperf_pairs(net, stride_pairs(hosts, len(hosts) // 2), duration)
+			results.append((app, env, sum(rates)))
+		finally:
+			net.stop()
+			controller.terminate()
+			controller.wait()
+	for app, env, total in results:
+		print("%-14s %-14s %8.2f Mbit/s" % (app, " ".join("%s=%s" % kv for kv in env.items()), total))
+
+# Ryu apps the benchmark harness can run
+CONTROLLERS = {"sp": "sp_routing.py", "ft": "ft_routing.py"}
+
+# Traffic patterns of the benchmark harness
+PATTERNS = ["stride", "random", "staggered", "all-to-all"]
+
+def host_position(host):
+	# (pod, edge switch) of a host from its 10.pod.switch.id address
+	_, pod, edge, _ = host.IP().split(".")
+	return int(pod), int(edge)
+
+def random_pairs(hosts, rng):
+	# every host sends to another host chosen uniformly
+	return [(src, rng.choice([h for h in hosts if h is not src])) for src in hosts]
+
+def staggered_pairs(hosts, rng, edge_p=0.5, pod_p=0.3):
+	# every host sends under its own edge switch with probability edge_p,
+	# elsewhere in its pod with probability pod_p, else to another pod
+	pairs = []
+	for src in hosts:
+		pod, edge = host_position(src)
+		same_edge = [h for h in hosts if h is not src and host_position(h) == (pod, edge)]
+		same_pod = [h for h in hosts if host_position(h)[0] == pod and host_position(h)[1] != edge]
+		other = [h for h in hosts if host_position(h)[0] != pod]
+		draw = rng.random()
+		if draw < edge_p and same_edge:
+			choices = same_edge
+		elif draw < edge_p + pod_p and same_pod:
+			choices = same_pod
+		else:
+			choices = other or same_pod or same_edge
+		pairs.append((src, rng.choice(choices)))
+	return pairs
+
+def all_to_all_pairs(hosts):
+	return [(src, dst) for src in hosts for dst in hosts if src is not dst]
+
+def pattern_pairs(pattern, hosts, rng):
+	if pattern == "stride":
+		return stride_pairs(hosts, len(hosts) // 2)
+	if pattern == "random":
+		return random_pairs(hosts, rng)
+	if pattern == "staggered":
+		return staggered_pairs(hosts, rng)
+	return all_to_all_pairs(hosts)
+
+def percentiles(values, ps=(50, 90, 99)):
+	# nearest-rank percentiles, plus the mean and the extremes
+	values = sorted(v for v in values if v is not None)
+	if not values:
+		return None
+	summary = {"p%d" % p: values[min(len(values) - 1, int(math.ceil(p / 100.0 * len(values))) - 1)]
+	           for p in ps}
+	summary.update(min=values[0], max=values[-1], mean=sum(values) / len(values))
+	return summary
+
+def bench_pattern(net, pattern, rng, duration, flow_size):
+	# throughput, flow completion time and latency of one traffic pattern
+	pairs = pattern_pairs(pattern, net.hosts, rng)
+	rates = iperf_pairs(net, pairs, duration)
+	fcts = fct_pairs(pairs, flow_size)
+	rtts = ping_pairs(pairs)
+	return {
+		"flows": len(pairs),
+		"throughput_mbps": {"aggregate": sum(rates), "per_flow": percentiles(rates)},
+		"fct_s": {"flow_size_bytes": flow_size, "failed": fcts.count(None),
+		          "per_flow": percentiles(fcts)},
+		"latency_ms": percentiles(rtts),
+	}
+
+def bench(controller, k, patterns, env=None, duration=10, flow_size=1000000,
+          seed=0, bw=15, delay='5ms'):
+	# Start the network with one of CONTROLLERS, run the traffic patterns
+	# one after the other, tear everything down and return the results
+	lg.setLogLevel('warning')
+	env = env or {}
+	rng = random.Random(seed)
+	results = {"controller": controller, "env": env, "k": k, "bw_mbps": bw,
+	           "delay": delay, "duration_s": duration, "seed": seed, "patterns": {}}
+	mininet.clean.cleanup()
+	proc = start_controller(CONTROLLERS[controller], env, k)
+	net = make_mininet_instance(k, bw, delay)
+	try:
+		net.start()
+		net.waitConnected()
+		net.pingAll()
+		for pattern in patterns:
+			results["patterns"][pattern] = bench_pattern(
+				net, pattern, rng, duration, flow_size)
+	finally:
+		net.stop()
+		proc.terminate()
+		proc.wait()
+		mininet.clean.cleanup()
+	return results
+
+# Controllers compared by the link-down test: (ryu app, environment)
+FAILOVER_CONTROLLERS = [
+	("sp_routing.py", {"SP_PROACTIVE": "1", "SP_FAILOVER": "0"}),
+	("sp_routing.py", {"SP_PROACTIVE": "1", "SP_FAILOVER": "1"}),
+]
+
+def peer(intf):
+	# Interface at the other end of the link of intf
+	link = intf.link
+	return link.intf2 if link.intf1 is intf else link.intf1
+
+def tx_packets(intf):
+	return int(intf.node.cmd("cat /sys/class/net/%s/statistics/tx_packets" % intf.name))
+
+def busy_uplink(edge):
+	# The uplink of an edge switch carrying the most packets over a second
+	uplinks = [intf for intf in edge.intfList()
+	           if intf.link and peer(intf).node.name.startswith("2")]
+	before = [tx_packets(intf) for intf in uplinks]
+	time.sleep(1)
+	after = [tx_packets(intf) for intf in uplinks]
+	return max(zip([a - b for a, b in zip(after, before)], uplinks),
+	           key=lambda x: x[0])[1]
+
+def link_down_outage(net, src, dst, interval=0.01, duration=6):
+	# Ping dst from src, take down the uplink the pings use and return
+	# the outage in seconds (lost pings times the ping interval)
+	count = int(duration / interval)
+	ping = src.popen(["ping", "-i", str(interval), "-c", str(count), dst.IP()])
+	time.sleep(1)
+	edge = peer(src.defaultIntf()).node
+	uplink = busy_uplink(edge)
+	net.configLinkStatus(edge.name, peer(uplink).node.name, "down")
+	out, _ = ping.communicate()
+	net.configLinkStatus(edge.name, peer(uplink).node.name, "up")
+	for line in out.decode().splitlines():
+		if "received" in line:
+			fields = line.split(",")
+			sent = int(fields[0].split()[0])
+			received = int(fields[1].split()[0])
+			return (sent - received) * interval
+	return None
+
+def bench_failover(k, bw=15, delay='5ms'):
+	# Recovery time of a cross-pod flow after a link failure, with and
+	# without fast-failover groups
+	lg.setLogLevel('warning')
+	results = []
+	for app, env in FAILOVER_CONTROLLERS:
+		mininet.clean.cleanup()
+		controller = start_controller(app, env, k)
+		net = make_mininet_instance(k, bw, delay)
+		try:
+			net.start()
+			net.waitConnected()
+			net.pingAll()
+			results.append((app, env, link_down_outage(net, net.hosts[0], net.hosts[-1])))
+		finally:
+			net.stop()
+			controller.terminate()
+			controller.wait()
+	for app, env, outage in results:
+		shown = "lost" if outage is None else "%.3f s" % outage
+		print("%-14s %-30s %s" % (app, " ".join("%s=%s" % kv for kv in env.items()), shown))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Fat-tree network in Mininet")
+	parser.add_argument("mode", nargs="?", default="cli",
+	                    choices=["cli", "ecmp", "failover", "bench"])
+	parser.add_argument("-k", type=int, default=4,
+	                    help="switch port count, an even number")
+	parser.add_argument("--bw", type=float, default=15, help="link bandwidth in Mbit/s")
+	parser.add_argument("--delay", default="5ms", help="link delay")
+	parser.add_argument("--controller", choices=sorted(CONTROLLERS), default="sp",
+	                    help="routing app of the bench mode")
+	parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+	                    help="controller setting of the bench mode, e.g. SP_ECMP=1")
+	parser.add_argument("--pattern", action="append", choices=PATTERNS,
+	                    help="traffic pattern of the bench mode (default: all)")
+	parser.add_argument("--duration", type=int, default=10,
+	                    help="iperf duration in seconds")
+	parser.add_argument("--flow-size", type=int, default=1000000,
+	                    help="bytes per flow of the completion time runs")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--output", help="JSON result file (default: stdout)")
+	args = parser.parse_args()
+
+	if args.mode == "ecmp":
+		bench_ecmp(args.k, bw=args.bw, delay=args.delay)
+	elif args.mode == "failover":
+		bench_failover(args.k, bw=args.bw, delay=args.delay)
+	elif args.mode == "bench":
+		env = dict(setting.split("=", 1) for setting in args.env)
+		results = bench(args.controller, args.k, args.pattern or PATTERNS, env,
+		                args.duration, args.flow_size, args.seed, args.bw, args.delay)
+		if args.output:
+			with open(args.output, "w") as f:
+				json.dump(results, f, indent=2)
+		else:
+			print(json.dumps(results, indent=2))
+	else:
+		run(args.k, args.bw, args.delay)
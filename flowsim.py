@@ -0,0 +1,227 @@
+# Copyright 2020 Lin Wang
+
+# This code is part of the Advanced Computer Networks (2020) course at Vrije
+# Universiteit Amsterdam.
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+#!/usr/bin/env python3
+
+# Flow-level simulation of a topo.Jellyfish or topo.Fattree network: the
+# flows of a traffic matrix are routed over the switch graph and get
+# their max-min fair share of the link capacities, without Mininet
+
+import argparse
+import json
+import random
+
+import numpy as np
+
+import topo
+
+POLICIES = ["single", "ecmp", "ksp"]
+
+#max-min fair rates by progressive filling. Subflow i crosses the links
+#entry_link[j] for every j with entry_flow[j] == i; all the unfrozen
+#subflows grow together until a link saturates, which freezes the
+#subflows crossing it. Returns the rate of every subflow
+def max_min_fair(entry_flow, entry_link, capacity, num_flows, eps=1e-9):
+	entry_flow = np.asarray(entry_flow, dtype=np.int64)
+	entry_link = np.asarray(entry_link, dtype=np.int64)
+	remaining = np.array(capacity, dtype=float)
+	rates = np.zeros(num_flows)
+	active = np.ones(num_flows, dtype=bool)
+	#subflows without links are not limited by anything
+	active[np.setdiff1d(np.arange(num_flows), entry_flow)] = False
+	rates[~active] = np.inf
+	while active.any():
+		live = active[entry_flow]
+		users = np.bincount(entry_link[live], minlength=len(remaining))
+		loaded = users > 0
+		step = np.min(remaining[loaded] / users[loaded])
+		rates[active] += step
+		remaining -= step * users
+		saturated = loaded & (remaining <= eps * np.maximum(capacity, 1))
+		frozen = np.unique(entry_flow[live & saturated[entry_link]])
+		active[frozen] = False
+	return rates
+
+#a random permutation traffic matrix: every server sends to one other
+#server and receives from one
+def random_permutation(num_servers, rng):
+	while True:
+		dst = list(range(num_servers))
+		rng.shuffle(dst)
+		if all(s != d for s, d in enumerate(dst)):
+			return list(enumerate(dst))
+
+class FlowSim:
+
+	#topology is a topo.Jellyfish or topo.Fattree. Every direction of
+	#every link has capacity link_capacity, server links have
+	#server_capacity (link_capacity by default)
+	def __init__(self, topology, link_capacity=1.0, server_capacity=None):
+		self.topology = topology
+		self.graph = topology.graph
+		self.num_switches = len(topology.switches)
+		if server_capacity is None:
+			server_capacity = link_capacity
+
+		#directed link u->v as packed (u << 32) | v key -> link index
+		self.link_index = {}
+		self.links = []
+		capacity = []
+		switch_links = []
+		for key in sorted(self.graph.links):
+			u, v = key >> 32, key & 0xffffffff
+			switch_link = u < self.num_switches and v < self.num_switches
+			for a, b in ((u, v), (v, u)):
+				self.link_index[(a << 32) | b] = len(self.links)
+				self.links.append((a, b))
+				capacity.append(link_capacity if switch_link else server_capacity)
+				switch_links.append(switch_link)
+		self.capacity = np.array(capacity)
+		self.switch_links = np.array(switch_links, dtype=bool)
+		self.bfs_cache = {}
+		self.ksp_caches = {}
+
+	#switch of the server at position i of topology.servers
+	def server_switch(self, i):
+		return self.graph.adj[self.topology.servers[i].index][0]
+
+	#BFS distances toward dst over the switches, shared by all the flows
+	def distances(self, dst):
+		if dst not in self.bfs_cache:
+			self.bfs_cache[dst] = self.graph.bfs(dst, self.num_switches)[0]
+		return self.bfs_cache[dst]
+
+	#one shortest path, the same for every flow between two switches
+	def single_path(self, src, dst):
+		dist = self.distances(dst)
+		path = [src]
+		while path[-1] != dst:
+			u = path[-1]
+			path.append(min(v for v in self.graph.adj[u]
+			                if v < self.num_switches and dist[v] == dist[u] - 1))
+		return path
+
+	#a shortest path picking a random equal-cost next hop at every hop,
+	#as hashing switches do
+	def ecmp_path(self, src, dst, rng):
+		dist = self.distances(dst)
+		path = [src]
+		while path[-1] != dst:
+			u = path[-1]
+			path.append(rng.choice([v for v in self.graph.adj[u]
+			                        if v < self.num_switches and dist[v] == dist[u] - 1]))
+		return path
+
+	#k-shortest-paths cache of the switch graph for k
+	def ksp_cache(self, k):
+		if k not in self.ksp_caches:
+			self.ksp_caches[k] = topo.KPathCache(self.graph, k)
+		return self.ksp_caches[k]
+
+	def k_shortest_paths(self, src, dst, k):
+		return self.ksp_cache(k).paths(src, dst)
+
+	#switch paths of a flow: one for single and ecmp, up to k for ksp,
+	#the flow being split into one subflow per path
+	def switch_paths(self, policy, src, dst, k, rng):
+		if src == dst:
+			return [[src]]
+		if self.distances(dst)[src] < 0:
+			return []
+		if policy == "single":
+			return [self.single_path(src, dst)]
+		if policy == "ecmp":
+			return [self.ecmp_path(src, dst, rng)]
+		if policy == "ksp":
+			return self.k_shortest_paths(src, dst, k)
+		raise ValueError("unknown routing policy %r" % policy)
+
+	#route the (src, dst) server pairs with policy and return the
+	#throughput of every flow (sum of its subflows, 0 if unroutable) and
+	#the utilisation of every directed link of self.links. The k shortest
+	#paths are computed on processes worker processes first
+	def run(self, pairs, policy="single", k=8, seed=None, processes=None):
+		rng = random.Random(seed)
+		servers = self.topology.servers
+		if policy == "ksp":
+			switch_pairs = set((self.server_switch(s), self.server_switch(d)) for s, d in pairs)
+			self.ksp_cache(k).precompute([(a, b) for a, b in switch_pairs if a != b],
+			                             processes)
+		entry_flow = []
+		entry_link = []
+		owner = []
+		for flow, (s, d) in enumerate(pairs):
+			if s == d:
+				raise ValueError("flow %d goes from server %d to itself" % (flow, s))
+			src, dst = servers[s].index, servers[d].index
+			for path in self.switch_paths(policy, self.server_switch(s),
+			                              self.server_switch(d), k, rng):
+				nodes = [src] + path + [dst]
+				for u, v in zip(nodes, nodes[1:]):
+					entry_flow.append(len(owner))
+					entry_link.append(self.link_index[(u << 32) | v])
+				owner.append(flow)
+
+		sub_rates = max_min_fair(entry_flow, entry_link, self.capacity, len(owner))
+		rates = np.bincount(np.asarray(owner, dtype=np.int64), weights=sub_rates,
+		                    minlength=len(pairs))
+		used = np.bincount(np.asarray(entry_link, dtype=np.int64),
+		                   weights=sub_rates[np.asarray(entry_flow, dtype=np.int64)],
+		                   minlength=len(self.links))
+		return rates, used / self.capacity
+
+#summary statistics of a simulation run, switch_links masking the links
+#between two switches
+def summarise(rates, utilisation, switch_links):
+	switch_util = utilisation[switch_links]
+	return {
+		"flows": len(rates),
+		"throughput": {
+			"mean": float(np.mean(rates)),
+			"min": float(np.min(rates)),
+			"p10": float(np.percentile(rates, 10)),
+			"p50": float(np.percentile(rates, 50)),
+			"total": float(np.sum(rates)),
+		},
+		"switch_link_utilisation": {
+			"mean": float(np.mean(switch_util)) if len(switch_util) else 0.0,
+			"max": float(np.max(switch_util)) if len(switch_util) else 0.0,
+		},
+	}
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Flow-level max-min fair simulation")
+	parser.add_argument("topology", choices=["jellyfish", "fattree"])
+	parser.add_argument("-k", type=int, default=4, help="fat-tree port count")
+	parser.add_argument("--servers", type=int, default=686)
+	parser.add_argument("--switches", type=int, default=245)
+	parser.add_argument("--ports", type=int, default=14)
+	parser.add_argument("--policy", choices=POLICIES, default="ksp")
+	parser.add_argument("--paths", type=int, default=8, help="k of k-shortest paths")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--processes", type=int, default=None,
+	                    help="k-shortest-paths worker processes (default: one per core)")
+	args = parser.parse_args()
+
+	if args.topology == "jellyfish":
+		net = topo.Jellyfish(args.servers, args.switches, args.ports, seed=args.seed)
+	else:
+		net = topo.Fattree(args.k)
+	sim = FlowSim(net)
+	pairs = random_permutation(len(net.servers), random.Random(args.seed))
+	rates, utilisation = sim.run(pairs, args.policy, args.paths, args.seed, args.processes)
+	print(json.dumps(summarise(rates, utilisation, sim.switch_links), indent=2))
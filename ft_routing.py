@@ -1,6 +1,6 @@
 # Copyright 2020 Lin Wang
 
-# This code is part of the Advanced Computer Networks (2020) course at Vrije 
+# This code is part of the Advanced Computer Networks (2020) course at Vrije
 # Universiteit Amsterdam.
 
 # Licensed under the Apache License, Version 2.0 (the "License"); you may not
@@ -17,59 +17,55 @@
 
 #!/usr/bin/env python3
 
+import os
+
 from ryu.base import app_manager
-from ryu.controller import mac_to_port
 from ryu.controller import ofp_event
 from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER
 from ryu.controller.handler import set_ev_cls
 from ryu.ofproto import ofproto_v1_3
-from ryu.lib.mac import haddr_to_bin
 from ryu.lib.packet import packet
-from ryu.lib.packet import ipv4
-from ryu.lib.packet import arp
-
-from ryu.topology import event, switches
-from ryu.topology.api import get_all_switch, get_switch, get_link
-from ryu.app.wsgi import ControllerBase
+from ryu.lib.packet import ethernet
+from ryu.lib.packet import ether_types
 
 import topo
 
 class FTRouter(app_manager.RyuApp):
+    """
+        Static two-level routing for a k-ary fat-tree (Al-Fares et al.):
+        hosts are addressed 10.pod.switch.id as in topo.Fattree and every
+        switch gets its whole table when it connects.
+    """
 
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
 
-    def __init__(self, *args, **kwargs):
-        super(FTRouter, self).__init__(*args, **kwargs)
-        self.topo_net = topo.Fattree(4)
-        self.core_list=["10","11","12","13"]
-        self.pod_list=["20", "21", "22", "23", "24", "25", "26", "27", "30", "31", "32", "33", "34", "35", "36", "37"]
-
-    # Topology discovery
-    @set_ev_cls(event.EventSwitchEnter)
-    def get_topology_data(self, ev):
-        # Switches and links in the network
-        switches = get_all_switch(self)
-        #self.switch_manager(switches)
-        links = get_link(self, None)
-        #self.link_manager(self, links) 
-
-    #def install_core(datapath):
+    # Priorities of the terminating prefixes and of the suffix table
+    PREFIX_PRIORITY = 20
+    SUFFIX_PRIORITY = 10
 
+    # Hash upward traffic over all the uplinks with a select group instead
+    # of the static host-id suffix rules (FT_ECMP=1)
+    ECMP = os.environ.get("FT_ECMP", "0") == "1"
+    UPLINK_GROUP = 1
 
+    def __init__(self, *args, **kwargs):
+        super(FTRouter, self).__init__(*args, **kwargs)
+        # Share a topology saved with topo.save() if one is given
+        topo_file = os.environ.get("FT_TOPO_FILE")
+        if topo_file:
+            self.topo_net = topo.load(topo_file)
+        else:
+            self.topo_net = topo.Fattree(int(os.environ.get("FT_K", "4")))
+        self.k = self.topo_net.num_pod
+        self.switch_roles = self.topo_net.dpid_map()   # dpid->(role,pod,position)
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
-    def switch_features_handler(self, ev):  
+    def switch_features_handler(self, ev):
 
         datapath = ev.msg.datapath
         ofproto = datapath.ofproto
-        parser = datapath.ofproto_parser        
-        """ 
-        print ("SW DP ID", datapath.id)
-        if str(datapath.id) in self.core_list :
-            self.install_core(datapath,parser)
-        else:
-            self.install_pod(datapath)
-        """
+        parser = datapath.ofproto_parser
+
         match = parser.OFPMatch()
         actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
                                           ofproto.OFPCML_NO_BUFFER)]
@@ -79,19 +75,94 @@ class FTRouter(app_manager.RyuApp):
         ignore_actions = []
         self.add_flow(datapath, 65534, ignore_match, ignore_actions)
 
+        role = self.switch_roles.get(datapath.id)
+        if role is None:
+            self.logger.warning("switch %s is not part of the k=%d fat-tree",
+                                datapath.id, self.k)
+            return
+        kind, pod, position = role
+        if kind == "core":
+            self.install_core(datapath)
+        elif kind == "aggregation":
+            self.install_aggregation(datapath, pod, position)
+        else:
+            self.install_edge(datapath, pod, position)
 
+    def add_route(self, datapath, priority, dst, mask, port=None, actions=None):
+        """
+            Route IPv4 and ARP packets whose destination address matches
+            dst/mask to port (or through actions). ARP follows the same
+            paths as IP, so ARP requests reach their target without
+            flooding.
+        """
+        parser = datapath.ofproto_parser
+        if actions is None:
+            actions = [parser.OFPActionOutput(port)]
+        ip_match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP,
+                                   ipv4_dst=(dst, mask))
+        self.add_flow(datapath, priority, ip_match, actions)
+        arp_match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_ARP,
+                                    arp_tpa=(dst, mask))
+        self.add_flow(datapath, priority, arp_match, actions)
+
+    def host_ids(self):
+        return range(2, self.k // 2 + 2)
+
+    def install_core(self, datapath):
+        # One /16 prefix per pod
+        for pod in range(self.k):
+            self.add_route(datapath, self.PREFIX_PRIORITY,
+                           "10.%d.0.0" % pod, "255.255.0.0",
+                           self.topo_net.core_port(pod))
+
+    def install_suffixes(self, datapath, position, up_port):
+        half = self.k // 2
+        if self.ECMP:
+            self.install_uplink_group(datapath, [up_port(i) for i in range(half)])
+            return
 
-    def install_core(self,sw,parser):
-        ofproto = sw.ofproto
-        for p in range(0,self.topo_net.num_pod):
-            match = parser.OFPMatch(ipv4_dst="10.0.1.0/8", dp[0], mask=255.255.255.0)
-            actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
-                                          ofproto.OFPCML_NO_BUFFER)]
-            self.add_flow(sw, 0, match, actions)
-
-    def install_pod(self,sw):
-        print("QUI DOVREI INSTALLARE TABELLA POD")
+        # Spread upward traffic over the uplinks by host id
+        for host_id in self.host_ids():
+            uplink = (host_id - 2 + position) % half
+            self.add_route(datapath, self.SUFFIX_PRIORITY,
+                           "0.0.0.%d" % host_id, "0.0.0.255",
+                           up_port(uplink))
 
+    def install_uplink_group(self, datapath, ports):
+        # Everything not matched by a prefix goes up through a select
+        # group hashing flows over the uplinks
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        buckets = [parser.OFPBucket(weight=1, watch_port=port,
+                                    watch_group=ofproto.OFPG_ANY,
+                                    actions=[parser.OFPActionOutput(port)])
+                   for port in ports]
+        datapath.send_msg(parser.OFPGroupMod(
+            datapath, ofproto.OFPGC_DELETE, ofproto.OFPGT_ALL, ofproto.OFPG_ALL))
+        datapath.send_msg(parser.OFPGroupMod(
+            datapath, ofproto.OFPGC_ADD, ofproto.OFPGT_SELECT,
+            self.UPLINK_GROUP, buckets))
+        self.add_route(datapath, self.SUFFIX_PRIORITY, "0.0.0.0", "0.0.0.0",
+                       actions=[parser.OFPActionGroup(self.UPLINK_GROUP)])
+
+    def install_aggregation(self, datapath, pod, position):
+        # In-pod subnets go down to their edge switch
+        for edge in range(self.k // 2):
+            self.add_route(datapath, self.PREFIX_PRIORITY,
+                           "10.%d.%d.0" % (pod, edge), "255.255.255.0",
+                           self.topo_net.aggregation_down_port(edge))
+        self.install_suffixes(datapath, position,
+                              self.topo_net.aggregation_up_port)
+
+    def install_edge(self, datapath, pod, position):
+        # Directly attached hosts
+        for host_id in self.host_ids():
+            self.add_route(datapath, self.PREFIX_PRIORITY,
+                           "10.%d.%d.%d" % (pod, position, host_id),
+                           "255.255.255.255",
+                           self.topo_net.edge_host_port(host_id))
+        self.install_suffixes(datapath, position,
+                              self.topo_net.edge_up_port)
 
     # Add a flow entry to the flow-table
     def add_flow(self, datapath, priority, match, actions):
@@ -110,13 +181,14 @@ class FTRouter(app_manager.RyuApp):
         msg = ev.msg
         datapath = msg.datapath
         dpid = datapath.id
-        ofproto = datapath.ofproto
-        parser = datapath.ofproto_parser
 
-        # TODO: handle new packets at the controller
-        if eth_type == ether_types.ETH_TYPE_LLDP:
+        pkt = packet.Packet(msg.data)
+        eth_pkt = pkt.get_protocol(ethernet.ethernet)
+        if eth_pkt is None or eth_pkt.ethertype == ether_types.ETH_TYPE_LLDP:
             # ignore lldp packet
             return
 
-        print ("Packet sended by: ", dpid)
-        print ("MSG: ", msg)
\ No newline at end of file
+        # Every host is covered by the static tables, anything reaching
+        # the controller is outside the fat-tree address plan
+        self.logger.debug("unrouted packet from %s on port %s: %s",
+                          dpid, msg.match['in_port'], eth_pkt)
@@ -0,0 +1,182 @@
+# Copyright 2020 Lin Wang
+
+# This code is part of the Advanced Computer Networks (2020) course at Vrije
+# Universiteit Amsterdam.
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+#!/usr/bin/env python3
+
+import argparse
+import ipaddress
+
+import topo
+
+# Next hop of the addresses of no known host: the table-miss rule sends
+# them to the controller, which learns where they are
+CONTROLLER = None
+
+
+class _Node(object):
+    """
+        Binary trie node over the destination address bits, with the
+        candidate next hops of its subtree, None if any next hop does.
+    """
+    __slots__ = ('value', 'length', 'left', 'right', 'hops')
+
+    def __init__(self, value, length, left=None, right=None, hops=None):
+        self.value = value
+        self.length = length
+        self.left = left
+        self.right = right
+        self.hops = hops
+
+
+_NO_HOST = frozenset([CONTROLLER])
+
+
+def _build(addrs, routes, value, length, plan_nets, plan_prefix):
+    """
+        Trie of the sorted host addresses addrs that share the first
+        length bits of value, with the ORTC candidate sets: the
+        intersection of the children's sets when it is not empty, their
+        union otherwise. A host without a route goes to the controller.
+        A subtree without hosts is a don't-care leaf inside a network of
+        plan_nets, a leaf going to the controller elsewhere.
+    """
+    if not addrs:
+        if length >= plan_prefix and value >> (32 - plan_prefix) in plan_nets:
+            return _Node(value, length, hops=None)
+        return _Node(value, length, hops=_NO_HOST)
+    if length == 32:
+        return _Node(value, length, hops=frozenset([routes.get(value, CONTROLLER)]))
+    bit = 1 << (31 - length)
+    split = 0
+    while split < len(addrs) and not addrs[split] & bit:
+        split += 1
+    left = _build(addrs[:split], routes, value, length + 1, plan_nets, plan_prefix)
+    right = _build(addrs[split:], routes, value | bit, length + 1, plan_nets, plan_prefix)
+    if left.hops is None:
+        hops = right.hops
+    elif right.hops is None:
+        hops = left.hops
+    else:
+        hops = (left.hops & right.hops) or (left.hops | right.hops)
+    return _Node(value, length, left, right, hops)
+
+
+def _emit(node, inherited, rules):
+    if node.hops is None:
+        return
+    if inherited in node.hops:
+        hop = inherited
+    else:
+        hop = min(node.hops, key=repr)
+        rules.append((node.value, node.length, hop))
+    for child in (node.left, node.right):
+        if child is not None:
+            _emit(child, hop, rules)
+
+
+def compile_prefixes(routes, plan=(), plan_prefix=24):
+    """
+        Compress {host ip: next hop} into a minimal list of longest-prefix
+        rules (ip, mask, prefix length, next hop), with ORTC (Draves et
+        al.). Addresses without a route keep going to the controller: no
+        rule covers them, or one with the CONTROLLER next hop where a
+        shorter prefix around them saves rules. The /0 prefix is never
+        used, the table-miss rule stands for it.
+
+        plan lists the host addresses the addressing plan can give out.
+        The other addresses of the /plan_prefix networks holding them
+        never show up, so they are don't-cares that any rule may cover.
+    """
+    if not routes:
+        return []
+    by_value = {}
+    for ip, hop in routes.items():
+        by_value[int(ipaddress.IPv4Address(ip))] = hop
+    addrs = set(by_value)
+    plan_nets = set()
+    for ip in plan:
+        value = int(ipaddress.IPv4Address(ip))
+        addrs.add(value)
+        plan_nets.add(value >> (32 - plan_prefix))
+    root = _build(sorted(addrs), by_value, 0, 0, plan_nets, plan_prefix)
+    values = []
+    _emit(root.left, CONTROLLER, values)
+    _emit(root.right, CONTROLLER, values)
+    rules = []
+    for value, length, hop in values:
+        network = ipaddress.IPv4Network((value, length))
+        rules.append((str(network.network_address), str(network.netmask),
+                      length, hop))
+    return rules
+
+
+def lookup(rules, ip):
+    """
+        Next hop of ip in compiled rules by longest prefix match,
+        CONTROLLER if no rule matches.
+    """
+    value = int(ipaddress.IPv4Address(ip))
+    best = None
+    for addr, mask, length, hop in rules:
+        if value & int(ipaddress.IPv4Address(mask)) == int(ipaddress.IPv4Address(addr)):
+            if best is None or length > best[0]:
+                best = (length, hop)
+    return CONTROLLER if best is None else best[1]
+
+
+def fattree_rule_counts(k):
+    """
+        Per-switch ipv4_dst rule counts of single shortest-path routing on
+        a k-ary topo.Fattree, as {switch id: (host rules, prefix rules)}.
+        Every switch forwards toward the lowest-numbered neighbour on a
+        shortest path, as a hop count tie-break would. The server
+        addresses are the addressing plan, so the unused host ids of
+        every edge switch /24 are don't-cares.
+    """
+    fattree = topo.Fattree(k)
+    graph = fattree.graph
+    limit = len(fattree.switches)
+    tables = dict((sw.index, {}) for sw in fattree.switches)
+    plan = [server.id for server in fattree.servers]
+    distances = {}
+    for server in fattree.servers:
+        edge = graph.adj[server.index][0]
+        if edge not in distances:
+            distances[edge] = graph.bfs(edge, limit)[0]
+        dist = distances[edge]
+        for sw in tables:
+            if sw == edge:
+                hop = ('host', server.index)
+            else:
+                hop = min(v for v in graph.adj[sw] if v < limit and dist[v] == dist[sw] - 1)
+            tables[sw][server.id] = hop
+    return dict((graph.ids[sw], (len(routes), len(compile_prefixes(routes, plan))))
+                for sw, routes in tables.items())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fat-tree routing table compression")
+    parser.add_argument("-k", type=int, default=4)
+    args = parser.parse_args()
+
+    counts = fattree_rule_counts(args.k)
+    for sw in sorted(counts):
+        print("%-14s %6d %6d" % (sw, counts[sw][0], counts[sw][1]))
+    print("%-14s %6d %6d" % ("total", sum(c[0] for c in counts.values()),
+                             sum(c[1] for c in counts.values())))
+    print("%-14s %6d %6d" % ("max", max(c[0] for c in counts.values()),
+                             max(c[1] for c in counts.values())))
@@ -17,6 +17,10 @@
 
 #!/usr/bin/env python3
 
+import ipaddress
+import os
+import time
+
 import networkx as nx
 from ryu.base import app_manager
 from ryu.controller import mac_to_port
@@ -35,26 +39,140 @@ from ryu.topology import event, switches
 from ryu.topology.api import get_all_switch, get_all_link, get_switch, get_link
 from ryu.app.wsgi import ControllerBase
 
+import rule_compiler
 import topo
 
 class SPRouter(app_manager.RyuApp):
 
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
 
+    # Log the route cache hit/miss counts every that many lookups
+    ROUTE_STATS_INTERVAL = 1000
+
+    # Switch and link events keep the graph up to date; every
+    # RESYNC_INTERVAL seconds it is also checked against the topology
+    # app, in case an event was missed
+    RESYNC_INTERVAL = 30.0         # seconds
+
+    # Push the routes toward every learned host to all the switches ahead
+    # of time instead of on the first packet-in (SP_PROACTIVE=1)
+    PROACTIVE = os.environ.get("SP_PROACTIVE", "0") == "1"
+
+    # Spread traffic over all the equal-cost next hops with OpenFlow
+    # select groups instead of following a single path (SP_ECMP=1)
+    ECMP = os.environ.get("SP_ECMP", "0") == "1"
+
+    # Poll port and flow statistics, track link utilisation and move
+    # elephant flows to the least loaded shortest path (SP_MONITOR=1).
+    # A flow gets its own counting rule at its ingress switch once the
+    # ipv4_dst rule it follows there carries an elephant's worth of traffic
+    MONITOR = os.environ.get("SP_MONITOR", "0") == "1"
+    MONITOR_MIN_INTERVAL = 1.0     # seconds, while links are busy
+    MONITOR_MAX_INTERVAL = 8.0     # seconds, while the network is idle
+    BUSY_UTILISATION = 0.5
+    LINK_BANDWIDTH = 15e6          # bit/s, as configured by FattreeNet
+    ELEPHANT_THRESHOLD = 0.1       # fraction of the link bandwidth
+    FLOW_PRIORITY = 100            # per (src, dst) rules, above ipv4_dst
+    FLOW_IDLE_TIMEOUT = 10
+    REROUTE_MIN_GAIN = 0.1         # utilisation an elephant move must save
+
+    # Route on link costs built from the measured latency and utilisation
+    # instead of hop counts (SP_WEIGHTED=1). A link costs
+    # 1 + LATENCY_WEIGHT * latency[ms] + UTIL_WEIGHT * utilisation, and
+    # its weight only moves to its cost once the cost has stayed more
+    # than WEIGHT_HYSTERESIS away from it for WEIGHT_HOLD_TIME, so that
+    # routes don't flap. Elephants are moved over the least loaded of
+    # the paths of least weight.
+    # Moved weights re-route the proactive routes, or without
+    # SP_PROACTIVE the ipv4_dst rules the switches already hold
+    WEIGHTED = os.environ.get("SP_WEIGHTED", "0") == "1"
+    LATENCY_WEIGHT = float(os.environ.get("SP_LATENCY_WEIGHT", "1"))
+    UTIL_WEIGHT = float(os.environ.get("SP_UTIL_WEIGHT", "4"))
+    WEIGHT_HYSTERESIS = 0.2
+    WEIGHT_HOLD_TIME = 10.0        # seconds
+    LATENCY_SMOOTHING = 0.5        # weight of a new sample
+
+    # Forward through fast-failover groups falling back to loop-free
+    # alternate next hops when the primary port goes down, and clean up
+    # the flows and groups using a dead port that long after (SP_FAILOVER=1).
+    # The alternates only hold a rule toward every host with SP_PROACTIVE;
+    # without it there are no fast-failover groups, only the cleanup
+    FAILOVER = os.environ.get("SP_FAILOVER", "0") == "1"
+    FAILOVER_CLEANUP_DELAY = 1.0   # seconds
+
+    # Answer ARP requests from the controller's IP->MAC table and flood
+    # requests for an unknown address at most once per ARP_FLOOD_INTERVAL,
+    # with one packet-out per switch (SP_ARP_PROXY=1). SP_FATTREE_K=k
+    # pre-seeds the table with the addresses of a k-ary fat-tree
+    ARP_PROXY = os.environ.get("SP_ARP_PROXY", "0") == "1"
+    ARP_FLOOD_INTERVAL = 1.0       # seconds
+    ARP_STATS_INTERVAL = 100       # ARP packets between two log lines
+
+    # Compile the ipv4_dst rules of every switch, proactive or reactive,
+    # into a minimal set of prefixes instead of one rule per host
+    # (SP_COMPRESS=1). The longest prefix wins: a /n rule gets
+    # PREFIX_PRIORITY + n. Addresses of no known host still reach the
+    # controller, through the table-miss rule or a prefix sending to it.
+    # With SP_FATTREE_K=k the unused host ids of the fat-tree's /24s are
+    # left to whichever prefix covers them
+    COMPRESS = os.environ.get("SP_COMPRESS", "0") == "1"
+    PREFIX_PRIORITY = 20
+
     def __init__(self, *args, **kwargs):
         super(SPRouter, self).__init__(*args, **kwargs)
         #self.arp_handler = kwargs["ArpHandler"]
         self.datapaths = {}
         self.topology_api_app = self
         self.link_to_port = {}       # (src_dpid,dst_dpid)->(src_port,dst_port)
-        self.access_table = {}       # {(sw,port) :[host1_ip]}
+        self.access_table = {}       # {(sw,port) :(host_ip, host_mac)}
+        self.ip_to_location = {}     # host_ip->(sw,port)
+        self.mac_to_location = {}    # host_mac->(sw,port)
         self.switch_port_table = {}  # dpip->port_num
         self.access_ports = {}       # dpid->port_num
         self.interior_ports = {}     # dpid->port_num
         self.graph = nx.DiGraph()
+        self.route_cache = {}        # src_dpid->{dst_dpid: path}
+        self.route_hits = 0
+        self.route_misses = 0
+        self.flow_batches = {}       # dpid->(datapath, [flow_mod])
+        self.pending_barriers = {}   # (dpid,xid)->([transaction], [rule])
+        self.awaited_rules = []      # (dpid,rule) in flight, skipped by queue_flow
+        self.flow_table = {}         # dpid->{(priority,match):[actions,state]}
+        self.flow_stats = {}         # dpid->[rule] of a flow stats reply
+        self.groups = {}             # dpid->{(type,port,...): group_id}
+        self.last_group_id = {}      # dpid->highest group id ever used
+        self.port_counters = {}      # (dpid,port)->(tx_bytes, time)
+        self.flow_counters = {}      # (ip_src,ip_dst)->(byte_count, time)
+        self.rule_counters = {}      # (dpid,rule)->(byte_count, time)
+        self.elephant_paths = {}     # (ip_src,ip_dst)->path
+        self.monitor_interval = self.MONITOR_MAX_INTERVAL
+        self.echo_latency = {}       # dpid->controller round trip time
+        self.weights_changed = False
+        self.switches_app = None
+        self.lldp_ports = {}         # (dpid,port_no)->PortData of switches_app
+        self.host_routes = {}        # dpid->{host_ip: actions}
+        self.prefix_rules = {}       # dpid->{(ip, mask): priority}
+        self.dirty_routes = set()    # dpids whose host_routes changed
+        self.arp_table = {}          # host_ip->host_mac
+        self.arp_floods = {}         # host_ip->time of the last flood
+        self.arp_packets = 0
+        self.arp_packet_outs = 0
+        self.host_plan = []          # host_ips of the addressing plan
+        fattree_k = os.environ.get("SP_FATTREE_K")
+        if fattree_k:
+            fattree = topo.Fattree(int(fattree_k))
+            self.arp_table.update(fattree.server_macs())
+            self.host_plan = [server.id for server in fattree.servers]
+        if self.MONITOR or self.WEIGHTED:
+            self.monitor_thread = hub.spawn(self._monitor)
         self.dps = {}
-        self.switches = None
-        self.discover_thread = hub.spawn(self._discover)
+        self.switches = self.switch_port_table.keys()
+        self.resync_thread = hub.spawn(self._resync)
+
+    def _resync(self):
+        while True:
+            hub.sleep(self.RESYNC_INTERVAL)
+            self.get_topology_data()
 
     
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
@@ -65,6 +183,13 @@ class SPRouter(app_manager.RyuApp):
         msg = ev.msg
         dpid = datapath.id
         self.datapaths[dpid] = datapath        
+        # a (re)connected switch is resynchronised from its flow stats
+        self.flow_table[dpid] = {}
+
+        # and starts without groups
+        self.groups[dpid] = {}
+        datapath.send_msg(parser.OFPGroupMod(
+            datapath, ofproto.OFPGC_DELETE, ofproto.OFPGT_ALL, ofproto.OFPG_ALL))
 
         # install table-miss flow entry
         match = parser.OFPMatch()
@@ -88,6 +213,149 @@ class SPRouter(app_manager.RyuApp):
                                 match=match, instructions=inst)
         dp.send_msg(mod)
 
+    def rule_key(self, priority, match):
+        return (priority, tuple(sorted(match.items())))
+
+    def actions_key(self, actions):
+        return tuple((type(a).__name__, getattr(a, 'port', None),
+                      getattr(a, 'group_id', None)) for a in actions)
+
+    def queue_flow(self, dp, p, match, actions, idle_timeout=0):
+        """
+            Queue a flow entry for the next flush_flows(), unless the
+            shadow table shows it installed or in flight already. The
+            next flush_flows() waits for an entry in flight all the same.
+        """
+        ofproto = dp.ofproto
+        parser = dp.ofproto_parser
+
+        rule = self.rule_key(p, match)
+        actions_key = self.actions_key(actions)
+        table = self.flow_table.setdefault(dp.id, {})
+        if rule in table and table[rule][0] == actions_key:
+            if table[rule][1] == 'pending':
+                self.awaited_rules.append((dp.id, rule))
+            return False
+        table[rule] = [actions_key, 'pending']
+
+        inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
+                                             actions)]
+
+        mod = parser.OFPFlowMod(datapath=dp, priority=p,
+                                match=match, instructions=inst,
+                                idle_timeout=idle_timeout,
+                                flags=ofproto.OFPFF_SEND_FLOW_REM)
+        self.queue_msg(dp, mod, rule)
+        return True
+
+    def queue_msg(self, dp, msg, rule=None):
+        """
+            Queue any message for the next flush_flows(); rule is the
+            shadow table entry a flow-mod installs.
+        """
+        batch = self.flow_batches.setdefault(dp.id, (dp, [], []))
+        batch[1].append(msg)
+        if rule is not None:
+            batch[2].append(rule)
+
+    def flush_flows(self, callback=None):
+        """
+            Send the queued flow entries with one buffered write per
+            datapath, in the order the datapaths were first queued,
+            each batch followed by a barrier request. callback runs
+            once every datapath has acknowledged its barrier, and the
+            earlier barriers of the entries queue_flow found in flight.
+        """
+        batches, self.flow_batches = self.flow_batches, {}
+        awaited, self.awaited_rules = self.awaited_rules, []
+        transaction = {'waiting': set(), 'callback': callback}
+        for dpid, rule in awaited:
+            for key, (transactions, rules) in self.pending_barriers.items():
+                if key[0] == dpid and rule in rules and key not in transaction['waiting']:
+                    transaction['waiting'].add(key)
+                    transactions.append(transaction)
+
+        for dpid, (dp, mods, rules) in batches.items():
+            barrier = dp.ofproto_parser.OFPBarrierRequest(dp)
+            buf = bytearray()
+            for msg in mods + [barrier]:
+                dp.set_xid(msg)
+                msg.serialize()
+                buf += msg.buf
+            key = (dpid, barrier.xid)
+            transaction['waiting'].add(key)
+            self.pending_barriers[key] = ([transaction], rules)
+            dp.send(bytes(buf))
+
+        if not transaction['waiting'] and callback:
+            callback()
+
+    @set_ev_cls(ofp_event.EventOFPBarrierReply, MAIN_DISPATCHER)
+    def barrier_reply_handler(self, ev):
+        self.release_barrier((ev.msg.datapath.id, ev.msg.xid))
+
+    def release_barrier(self, key):
+        pending = self.pending_barriers.pop(key, None)
+        if pending is None:
+            return
+        transactions, rules = pending
+        table = self.flow_table.get(key[0], {})
+        for rule in rules:
+            if rule in table:
+                table[rule][1] = 'installed'
+        for transaction in transactions:
+            transaction['waiting'].discard(key)
+            if not transaction['waiting'] and transaction['callback']:
+                transaction['callback']()
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def flow_removed_handler(self, ev):
+        msg = ev.msg
+        rule = self.rule_key(msg.priority, msg.match)
+        self.flow_table.get(msg.datapath.id, {}).pop(rule, None)
+        self.rule_counters.pop((msg.datapath.id, rule), None)
+        if msg.priority == self.FLOW_PRIORITY:
+            flow = (msg.match.get('ipv4_src'), msg.match.get('ipv4_dst'))
+            self.flow_counters.pop(flow, None)
+            self.elephant_paths.pop(flow, None)
+
+    def request_flow_stats(self, dp):
+        parser = dp.ofproto_parser
+        self.flow_stats[dp.id] = []
+        dp.send_msg(parser.OFPFlowStatsRequest(dp))
+
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
+    def flow_stats_reply_handler(self, ev):
+        """
+            Bring the shadow table in line with the rules the switch
+            reports; rules still in flight are left alone.
+        """
+        msg = ev.msg
+        dp = msg.datapath
+        if dp.id not in self.flow_stats:
+            return
+        for stat in msg.body:
+            if stat.priority == self.FLOW_PRIORITY:
+                self.track_flow(dp.id, stat)
+            elif self.MONITOR and stat.match.get('ipv4_dst') is not None:
+                self.track_dst_rule(dp.id, stat)
+            actions = []
+            for inst in stat.instructions:
+                actions.extend(getattr(inst, 'actions', []))
+            self.flow_stats[dp.id].append(
+                (self.rule_key(stat.priority, stat.match), self.actions_key(actions)))
+        if msg.flags & dp.ofproto.OFPMPF_REPLY_MORE:
+            return
+
+        reported = dict(self.flow_stats.pop(dp.id))
+        table = self.flow_table.setdefault(dp.id, {})
+        for rule, (actions_key, state) in list(table.items()):
+            if state == 'installed' and reported.get(rule) != actions_key:
+                del table[rule]
+        for rule, actions_key in reported.items():
+            if rule not in table:
+                table[rule] = [actions_key, 'installed']
+
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def _packet_in_handler(self, ev):
 
@@ -103,7 +371,9 @@ class SPRouter(app_manager.RyuApp):
         eth_type = eth_pkt.ethertype
 
         if eth_type == ether_types.ETH_TYPE_LLDP:
-            # ignore lldp packet
+            # only used to measure link latencies
+            if self.WEIGHTED:
+                self.measure_link_latency(datapath.id, msg.data)
             return
 
         if ip_pkt:
@@ -121,20 +391,33 @@ class SPRouter(app_manager.RyuApp):
             self.register_access_info(datapath.id, in_port, arp_src_ip, mac)
 
         if isinstance(arp_pkt, arp.arp):
-            self.arp_forwarding(msg, arp_pkt.src_ip, arp_pkt.dst_ip)
+            self.arp_forwarding(msg, arp_pkt)
 
         if isinstance(ip_pkt, ipv4.ipv4):
             if len(pkt.get_protocols(ethernet.ethernet)):
                 self.shortest_forwarding(msg, eth_type, ip_pkt.src, ip_pkt.dst)
 
-    def arp_forwarding(self, msg, src_ip, dst_ip):
-        """ Send ARP packet to the destination host,
+    def arp_forwarding(self, msg, arp_pkt):
+        """ Answer an ARP request from the arp table with SP_ARP_PROXY,
+            else send the ARP packet to the destination host,
             if the dst host record is existed,
             else, flow it to the unknow access port.
         """
         datapath = msg.datapath
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
+        dst_ip = arp_pkt.dst_ip
+        self.arp_packets += 1
+        if self.arp_packets % self.ARP_STATS_INTERVAL == 0:
+            self.logger.info("arp: %d packets, %d packet-outs (%.2f per packet)",
+                             self.arp_packets, self.arp_packet_outs,
+                             self.arp_packet_outs / self.arp_packets)
+
+        dst_mac = self.arp_table.get(dst_ip)
+        if self.ARP_PROXY and arp_pkt.opcode == arp.ARP_REQUEST and dst_mac:
+            self.send_arp(datapath, msg.match['in_port'], arp.ARP_REPLY,
+                          dst_mac, dst_ip, arp_pkt.src_mac, arp_pkt.src_ip)
+            return
 
         result = self.get_host_location(dst_ip)
         if result:  # host record in access table.
@@ -144,8 +427,42 @@ class SPRouter(app_manager.RyuApp):
                                          ofproto.OFPP_CONTROLLER,
                                          out_port, msg.data)
             datapath.send_msg(out)
+            self.arp_packet_outs += 1
         else:
-            self.flood(msg)
+            self.flood(msg.data, dst_ip)
+
+    def send_arp(self, datapath, port, opcode, src_mac, src_ip, dst_mac, dst_ip):
+        """
+            Build an ARP packet and send it out of port of datapath.
+        """
+        eth_dst = dst_mac if opcode == arp.ARP_REPLY else 'ff:ff:ff:ff:ff:ff'
+        pkt = packet.Packet()
+        pkt.add_protocol(ethernet.ethernet(ethertype=ether_types.ETH_TYPE_ARP,
+                                           dst=eth_dst, src=src_mac))
+        pkt.add_protocol(arp.arp(opcode=opcode, src_mac=src_mac, src_ip=src_ip,
+                                 dst_mac=dst_mac, dst_ip=dst_ip))
+        pkt.serialize()
+        ofproto = datapath.ofproto
+        datapath.send_msg(self._build_packet_out(
+            datapath, ofproto.OFP_NO_BUFFER, ofproto.OFPP_CONTROLLER,
+            port, pkt.data))
+        self.arp_packet_outs += 1
+
+    def locate_host(self, msg, ip_src, ip_dst):
+        """
+            Ask for an IP destination whose location is unknown, on behalf
+            of the sender. The proxy never floods its ARP request, so the
+            destination may not have spoken yet; its reply registers it.
+        """
+        src_mac = packet.Packet(msg.data).get_protocol(ethernet.ethernet).src
+        pkt = packet.Packet()
+        pkt.add_protocol(ethernet.ethernet(ethertype=ether_types.ETH_TYPE_ARP,
+                                           dst='ff:ff:ff:ff:ff:ff', src=src_mac))
+        pkt.add_protocol(arp.arp(opcode=arp.ARP_REQUEST, src_mac=src_mac,
+                                 src_ip=ip_src, dst_mac='00:00:00:00:00:00',
+                                 dst_ip=ip_dst))
+        pkt.serialize()
+        self.flood(pkt.data, ip_dst)
 
     def _build_packet_out(self, datapath, buffer_id, src_port, dst_port, data):
         """
@@ -166,23 +483,42 @@ class SPRouter(app_manager.RyuApp):
             data=msg_data, in_port=src_port, actions=actions)
         return out
 
-    def flood(self, msg):
+    def flood(self, data, dst_ip=None):
         """
             Flood ARP packet to the access port
             which has no record of host.
+            With SP_ARP_PROXY, once per ARP_FLOOD_INTERVAL and address,
+            with one packet-out per switch.
         """
-        datapath = msg.datapath
-        ofproto = datapath.ofproto
-        parser = datapath.ofproto_parser
+        if self.ARP_PROXY:
+            now = time.time()
+            if now - self.arp_floods.get(dst_ip, 0) < self.ARP_FLOOD_INTERVAL:
+                return
+            self.arp_floods[dst_ip] = now
 
         for dpid in self.access_ports:
-            for port in self.access_ports[dpid]:
-                if (dpid, port) not in self.access_table.keys():
-                    datapath = self.datapaths[dpid]
-                    out = self._build_packet_out(
-                        datapath, ofproto.OFP_NO_BUFFER,
-                        ofproto.OFPP_CONTROLLER, port, msg.data)
-                    datapath.send_msg(out)
+            datapath = self.datapaths.get(dpid)
+            if datapath is None:
+                continue
+            ofproto = datapath.ofproto
+            parser = datapath.ofproto_parser
+            ports = [port for port in self.access_ports[dpid]
+                     if (dpid, port) not in self.access_table]
+            if not ports:
+                continue
+            if self.ARP_PROXY:
+                actions = [parser.OFPActionOutput(port) for port in ports]
+                datapath.send_msg(parser.OFPPacketOut(
+                    datapath=datapath, buffer_id=ofproto.OFP_NO_BUFFER,
+                    in_port=ofproto.OFPP_CONTROLLER, actions=actions, data=data))
+                self.arp_packet_outs += 1
+                continue
+            for port in ports:
+                out = self._build_packet_out(
+                    datapath, ofproto.OFP_NO_BUFFER,
+                    ofproto.OFPP_CONTROLLER, port, data)
+                datapath.send_msg(out)
+                self.arp_packet_outs += 1
 
     def shortest_forwarding(self, msg, eth_type, ip_src, ip_dst):
         """
@@ -202,9 +538,319 @@ class SPRouter(app_manager.RyuApp):
                 to_dst_match = parser.OFPMatch(
                     eth_type = eth_type, ipv4_dst = ip_dst)
                 port_no = self.set_shortest_path(ip_src, ip_dst, src_sw, dst_sw, to_dst_port, to_dst_match)
-                self.send_packet_out(datapath, msg.buffer_id, in_port, port_no, msg.data)
+                if port_no is not None:
+                    self.compile_routes()
+                    # Release the packet once the whole path is installed
+                    self.flush_flows(lambda: self.send_packet_out(
+                        datapath, msg.buffer_id, in_port, port_no, msg.data))
+            elif self.ARP_PROXY:
+                self.locate_host(msg, ip_src, ip_dst)
         return
 
+    def install_flow_counter(self, src_sw, dst_sw, eth_type, ip_src, ip_dst):
+        """
+            Give the flow its own rule at its ingress switch, forwarding
+            like the destination rule, so that flow stats count it.
+        """
+        dp = self.get_datapath(src_sw)
+        ports = self.next_hop_ports(src_sw, dst_sw)
+        if not ports:
+            return
+        match = dp.ofproto_parser.OFPMatch(
+            eth_type=eth_type, ipv4_src=ip_src, ipv4_dst=ip_dst)
+        self.queue_flow(dp, self.FLOW_PRIORITY, match,
+                        self.output_actions(dp, ports, dst_sw),
+                        idle_timeout=self.FLOW_IDLE_TIMEOUT)
+
+    def _monitor(self):
+        while True:
+            for dp in list(self.datapaths.values()):
+                parser = dp.ofproto_parser
+                dp.send_msg(parser.OFPPortStatsRequest(dp, 0, dp.ofproto.OFPP_ANY))
+                self.request_flow_stats(dp)
+                if self.WEIGHTED:
+                    dp.send_msg(parser.OFPEchoRequest(
+                        dp, data=("%.6f" % time.time()).encode()))
+            hub.sleep(self.monitor_interval)
+            self.adapt_monitor_interval()
+            self.apply_link_weights()
+
+    def adapt_monitor_interval(self):
+        """
+            Poll fast while some link is busy, back off while idle.
+        """
+        busy = any(attrs.get('util', 0) >= self.BUSY_UTILISATION
+                   for _, _, attrs in self.graph.edges(data=True))
+        if busy or self.elephant_paths:
+            self.monitor_interval = self.MONITOR_MIN_INTERVAL
+        else:
+            self.monitor_interval = min(self.monitor_interval * 2,
+                                        self.MONITOR_MAX_INTERVAL)
+
+    @set_ev_cls(ofp_event.EventOFPPortStatsReply, MAIN_DISPATCHER)
+    def port_stats_reply_handler(self, ev):
+        """
+            Turn tx byte counters into the utilisation of the links.
+        """
+        dpid = ev.msg.datapath.id
+        now = time.time()
+        out_links = {}
+        for nbr in self.graph.successors(dpid) if self.graph.has_node(dpid) else ():
+            out_links[self.graph[dpid][nbr]['src_port']] = nbr
+        for stat in ev.msg.body:
+            key = (dpid, stat.port_no)
+            last = self.port_counters.get(key)
+            self.port_counters[key] = (stat.tx_bytes, now)
+            if last is None or now <= last[1] or stat.port_no not in out_links:
+                continue
+            rate = 8 * (stat.tx_bytes - last[0]) / (now - last[1])
+            edge = self.graph[dpid][out_links[stat.port_no]]
+            edge['load'] = rate
+            edge['util'] = rate / self.LINK_BANDWIDTH
+            self.update_link_weight(dpid, out_links[stat.port_no])
+
+    @set_ev_cls(ofp_event.EventOFPEchoReply, MAIN_DISPATCHER)
+    def echo_reply_handler(self, ev):
+        try:
+            sent = float(ev.msg.data)
+        except ValueError:
+            return
+        self.echo_latency[ev.msg.datapath.id] = time.time() - sent
+
+    def measure_link_latency(self, dpid, data):
+        """
+            Latency of the link an LLDP probe of the topology app came
+            over: its age, minus half the controller round trips of both
+            switches.
+        """
+        if self.switches_app is None:
+            self.switches_app = app_manager.lookup_service_brick('switches')
+            if self.switches_app is None:
+                return
+        try:
+            src_dpid, src_port_no = switches.LLDPPacket.lldp_parse(data)
+        except switches.LLDPPacket.LLDPUnknownFormat:
+            return
+        if not self.graph.has_edge(src_dpid, dpid):
+            return
+        port_data = self.lldp_port_data(src_dpid, src_port_no)
+        if port_data is None:
+            return
+        delay = (time.time() - port_data.timestamp -
+                 self.echo_latency.get(src_dpid, 0) / 2 -
+                 self.echo_latency.get(dpid, 0) / 2)
+        edge = self.graph[src_dpid][dpid]
+        delay = max(delay, 0)
+        if 'latency' in edge:
+            delay = (self.LATENCY_SMOOTHING * delay +
+                     (1 - self.LATENCY_SMOOTHING) * edge['latency'])
+        edge['latency'] = delay
+        self.update_link_weight(src_dpid, dpid)
+
+    def lldp_port_data(self, dpid, port_no):
+        """
+            PortData of the topology app for a port, with the send time of
+            its last LLDP probe. The index is rebuilt on a miss.
+        """
+        port_data = self.lldp_ports.get((dpid, port_no))
+        if port_data is None and self.switches_app is not None:
+            self.lldp_ports = dict(((port.dpid, port.port_no), data)
+                                   for port, data in self.switches_app.ports.items())
+            port_data = self.lldp_ports.get((dpid, port_no))
+        return port_data
+
+    def link_cost(self, edge):
+        return (1 + self.LATENCY_WEIGHT * 1000 * edge.get('latency', 0) +
+                self.UTIL_WEIGHT * edge.get('util', 0))
+
+    def update_link_weight(self, src_dpid, dst_dpid):
+        """
+            Move the routing weight of a link to its current cost once
+            the cost has stayed outside the hysteresis band around the
+            weight for WEIGHT_HOLD_TIME. drift_time is when it left it.
+        """
+        if not self.WEIGHTED:
+            return
+        edge = self.graph[src_dpid][dst_dpid]
+        cost = self.link_cost(edge)
+        weight = edge.get('weight', 1)
+        if abs(cost - weight) <= self.WEIGHT_HYSTERESIS * weight:
+            edge.pop('drift_time', None)
+            return
+        now = time.time()
+        if now - edge.setdefault('drift_time', now) < self.WEIGHT_HOLD_TIME:
+            return
+        edge['weight'] = cost
+        del edge['drift_time']
+        self.weights_changed = True
+
+    def apply_link_weights(self):
+        """
+            Recompute the routes once per polling round if a weight moved.
+        """
+        if not self.weights_changed:
+            return
+        self.weights_changed = False
+        self.route_cache.clear()
+        if self.PROACTIVE:
+            self.refresh_host_routes()
+        else:
+            self.refresh_reactive_routes()
+
+    def refresh_reactive_routes(self):
+        """
+            Point the ipv4_dst rules the switches hold, installed or
+            compiled from reactive paths, at their current next hops.
+            Switches without a rule toward a host still get one on the
+            next packet-in.
+        """
+        for dpid, table in list(self.flow_table.items()):
+            dp = self.datapaths.get(dpid)
+            if dp is None:
+                continue
+            for priority, items in list(table):
+                match = dict(items)
+                if priority != 10 or 'ipv4_dst' not in match:
+                    continue
+                actions = self.route_actions(dp, match['ipv4_dst'])
+                if actions is not None:
+                    self.queue_flow(dp, 10, dp.ofproto_parser.OFPMatch(**match), actions)
+        for dpid, routes in list(self.host_routes.items()):
+            dp = self.datapaths.get(dpid)
+            if dp is None:
+                continue
+            for ip in list(routes):
+                actions = self.route_actions(dp, ip)
+                if actions is not None:
+                    self.set_host_route(dpid, ip, actions)
+        self.compile_routes()
+        self.flush_flows()
+
+    def route_actions(self, dp, ip):
+        """
+            Actions of dp toward the host ip along the current routes,
+            None if the host or a route to it is unknown.
+        """
+        location = self.get_host_location(ip)
+        if location is None:
+            return None
+        dst_dpid, dst_port = location
+        if dp.id == dst_dpid:
+            ports = [dst_port]
+        else:
+            ports = self.next_hop_ports(dp.id, dst_dpid)
+        if not ports:
+            return None
+        return self.output_actions(dp, ports, dst_dpid)
+
+    def track_flow(self, dpid, stat):
+        """
+            Measure the rate of a flow at its ingress switch and reroute
+            it when it becomes an elephant.
+        """
+        ip_src = stat.match.get('ipv4_src')
+        ip_dst = stat.match.get('ipv4_dst')
+        src_location = self.get_host_location(ip_src)
+        dst_location = self.get_host_location(ip_dst)
+        if not src_location or not dst_location or src_location[0] != dpid:
+            return
+        flow = (ip_src, ip_dst)
+        now = time.time()
+        last = self.flow_counters.get(flow)
+        self.flow_counters[flow] = (stat.byte_count, now)
+        if last is None or now <= last[1]:
+            return
+        rate = 8 * (stat.byte_count - last[0]) / (now - last[1])
+        if rate >= self.ELEPHANT_THRESHOLD * self.LINK_BANDWIDTH:
+            self.reroute_elephant(flow, rate, src_location[0], dst_location[0])
+
+    def track_dst_rule(self, dpid, stat):
+        """
+            Measure the rate of an ipv4_dst rule and, once it carries an
+            elephant's worth of traffic, split the flows from the hosts of
+            dpid toward its destinations out into counting rules, which
+            track_flow measures from the next poll on.
+        """
+        rule = self.rule_key(stat.priority, stat.match)
+        now = time.time()
+        last = self.rule_counters.get((dpid, rule))
+        self.rule_counters[(dpid, rule)] = (stat.byte_count, now)
+        if last is None or now <= last[1]:
+            return
+        rate = 8 * (stat.byte_count - last[0]) / (now - last[1])
+        if rate < self.ELEPHANT_THRESHOLD * self.LINK_BANDWIDTH:
+            return
+        dst = stat.match['ipv4_dst']
+        if isinstance(dst, tuple):
+            network = ipaddress.IPv4Network('%s/%s' % dst)
+            dsts = [ip for ip in self.ip_to_location
+                    if ipaddress.IPv4Address(ip) in network]
+        else:
+            dsts = [dst]
+        srcs = [ip for ip, location in self.ip_to_location.items()
+                if location[0] == dpid]
+        for ip_dst in dsts:
+            dst_location = self.ip_to_location.get(ip_dst)
+            if dst_location is None or dst_location[0] == dpid:
+                continue
+            for ip_src in srcs:
+                self.install_flow_counter(dpid, dst_location[0],
+                                          ether_types.ETH_TYPE_IP, ip_src, ip_dst)
+        self.flush_flows()
+
+    def path_utilisation(self, path, own_path=None, own=0):
+        """
+            Utilisation of the busiest link of path, leaving out the share
+            own of a flow measured on the links of own_path.
+        """
+        own_links = set(zip(own_path, own_path[1:])) if own_path else set()
+        return max(max(self.graph[a][b].get('util', 0) -
+                       (own if (a, b) in own_links else 0), 0)
+                   for a, b in zip(path, path[1:]))
+
+    def reroute_elephant(self, flow, rate, src_dpid, dst_dpid):
+        """
+            Move an elephant flow to the least loaded shortest path and
+            reserve its rate there until the next port stats. The load of
+            the flow itself is taken off its current path, and the move
+            has to save at least REROUTE_MIN_GAIN, so that a lone
+            elephant does not swing between two paths on every poll.
+        """
+        try:
+            paths = list(nx.all_shortest_paths(self.graph, src_dpid, dst_dpid,
+                                               weight='weight' if self.WEIGHTED else None))
+        except nx.NetworkXNoPath:
+            return
+        if len(paths) < 2:
+            return
+        current = self.elephant_paths.get(flow)
+        if current is None and not self.ECMP:
+            current = self.get_route(src_dpid, dst_dpid)
+        own = rate / self.LINK_BANDWIDTH
+        loads = dict((tuple(path), self.path_utilisation(path, current, own))
+                     for path in paths)
+        best = min(paths, key=lambda path: loads[tuple(path)])
+        if (current in paths and
+                loads[tuple(current)] - loads[tuple(best)] < self.REROUTE_MIN_GAIN):
+            return
+        self.logger.info("elephant %s -> %s (%.1f Mbit/s) moved to %s",
+                         flow[0], flow[1], rate / 1e6, best)
+        self.elephant_paths[flow] = best
+
+        dp = self.get_datapath(src_dpid)
+        match = dp.ofproto_parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP,
+                                           ipv4_src=flow[0], ipv4_dst=flow[1])
+        for index in range(len(best) - 2, -1, -1):
+            a, b = best[index], best[index + 1]
+            dp = self.get_datapath(a)
+            port_no = self.graph[a][b]['src_port']
+            self.queue_flow(dp, self.FLOW_PRIORITY, match,
+                            [dp.ofproto_parser.OFPActionOutput(port_no)],
+                            idle_timeout=self.FLOW_IDLE_TIMEOUT)
+            self.graph[a][b]['util'] = (self.graph[a][b].get('util', 0) +
+                                        rate / self.LINK_BANDWIDTH)
+        self.flush_flows()
+
     def get_sw(self, dpid, in_port, src, dst):
 
         src_sw = dpid
@@ -234,117 +880,456 @@ class SPRouter(app_manager.RyuApp):
             datapath.send_msg(out)
 
 
-    def _discover(self):
-        while True:
-            self.get_topology_data(None)
-            hub.sleep(1)
+    @set_ev_cls(event.EventSwitchEnter)
+    def switch_enter_handler(self, ev):
+        self.add_switch(ev.switch)
+
+    @set_ev_cls(event.EventSwitchLeave)
+    def switch_leave_handler(self, ev):
+        self.remove_switch(ev.switch.dp.id)
+
+    @set_ev_cls(event.EventLinkAdd)
+    def link_add_handler(self, ev):
+        self.add_link(ev.link)
+
+    @set_ev_cls(event.EventLinkDelete)
+    def link_delete_handler(self, ev):
+        self.remove_link(ev.link.src.dpid, ev.link.dst.dpid)
+
+    @set_ev_cls(event.EventPortAdd)
+    def port_add_handler(self, ev):
+        port = ev.port
+        self.lldp_ports.pop((port.dpid, port.port_no), None)
+        if port.dpid in self.switch_port_table:
+            self.switch_port_table[port.dpid].add(port.port_no)
+            self.update_access_ports(port.dpid)
+
+    @set_ev_cls(event.EventPortDelete)
+    def port_delete_handler(self, ev):
+        port = ev.port
+        self.lldp_ports.pop((port.dpid, port.port_no), None)
+        self.port_down(port.dpid, port.port_no)
+        if port.dpid in self.switch_port_table:
+            self.switch_port_table[port.dpid].discard(port.port_no)
+            self.update_access_ports(port.dpid)
+
+    @set_ev_cls(event.EventPortModify)
+    def port_modify_handler(self, ev):
+        port = ev.port
+        if port.is_down():
+            self.port_down(port.dpid, port.port_no)
 
-    def get_topology_data(self, ev):
+    def get_topology_data(self, ev=None):
         """
-            Get topology info
+            Resynchronise with the topology app, applying only
+            the differences with what is already known.
         """
-        # print "get topo"
         switch_list = get_all_switch(self)
-        # print switch_list
-        self.create_port_map(switch_list)
-        self.switches = self.switch_port_table.keys()
-        links = get_link(self.topology_api_app, None)
-        self.create_interior_links(links)
-        self.create_access_ports()
+        current = set()
+        for sw in switch_list:
+            current.add(sw.dp.id)
+            ports = set(p.port_no for p in sw.ports)
+            if self.switch_port_table.get(sw.dp.id) != ports:
+                self.add_switch(sw)
+        for dpid in list(self.switch_port_table):
+            if dpid not in current:
+                self.remove_switch(dpid)
         self.get_graph()
 
-    def create_port_map(self, switch_list):
-        for sw in switch_list:
-            dpid = sw.dp.id
-            self.graph.add_node(dpid)
-            self.dps[dpid] = sw.dp          #dataoath switch
-            self.switch_port_table.setdefault(dpid, set())
-            self.interior_ports.setdefault(dpid, set())
-            self.access_ports.setdefault(dpid, set())
-
-            for p in sw.ports:
-                self.switch_port_table[dpid].add(p.port_no)
-
-    def create_interior_links(self, link_list):
-        for link in link_list:
-            src = link.src
-            dst = link.dst
-            self.link_to_port[
-                (src.dpid, dst.dpid)] = (src.port_no, dst.port_no)
-
-            # Find the access ports and interiorior ports
-            if link.src.dpid in self.switches:
-                self.interior_ports[link.src.dpid].add(link.src.port_no)
-            if link.dst.dpid in self.switches:
-                self.interior_ports[link.dst.dpid].add(link.dst.port_no)
-
-    def create_access_ports(self):
-        for sw in self.switch_port_table:
-            all_port_table = self.switch_port_table[sw]
-            interior_port = self.interior_ports[sw]
-            self.access_ports[sw] = all_port_table - interior_port
-        
+    def add_switch(self, sw):
+        dpid = sw.dp.id
+        self.graph.add_node(dpid)
+        self.dps[dpid] = sw.dp          #dataoath switch
+        self.switch_port_table[dpid] = set(p.port_no for p in sw.ports)
+        for port_no in self.switch_port_table[dpid]:
+            self.lldp_ports.pop((dpid, port_no), None)
+        self.interior_ports.setdefault(dpid, set())
+        self.update_access_ports(dpid)
+        self.request_flow_stats(sw.dp)
+
+    def remove_switch(self, dpid):
+        for (src, dst) in list(self.link_to_port):
+            if dpid in (src, dst):
+                self.remove_link(src, dst)
+        for location in [loc for loc in self.access_table if loc[0] == dpid]:
+            self.unregister_access_info(location)
+        if self.graph.has_node(dpid):
+            self.graph.remove_node(dpid)
+        self.route_cache.pop(dpid, None)
+        self.flow_batches.pop(dpid, None)
+        self.flow_table.pop(dpid, None)
+        self.flow_stats.pop(dpid, None)
+        for key in [k for k in self.rule_counters if k[0] == dpid]:
+            del self.rule_counters[key]
+        self.groups.pop(dpid, None)
+        self.host_routes.pop(dpid, None)
+        self.prefix_rules.pop(dpid, None)
+        self.dirty_routes.discard(dpid)
+        for key in [k for k in self.pending_barriers if k[0] == dpid]:
+            self.release_barrier(key)
+        for table in (self.switch_port_table, self.interior_ports,
+                      self.access_ports, self.dps, self.datapaths):
+            table.pop(dpid, None)
+
+    def add_link(self, link):
+        src = link.src
+        dst = link.dst
+        self.link_to_port[
+            (src.dpid, dst.dpid)] = (src.port_no, dst.port_no)
+        self.graph.add_edge(src.dpid, dst.dpid,
+                            src_port=src.port_no,
+                            dst_port=dst.port_no)
+        self.invalidate_routes_link_added(src.dpid, dst.dpid)
+        self.refresh_host_routes()
+
+        # Find the access ports and interiorior ports
+        for dpid, port_no in ((src.dpid, src.port_no), (dst.dpid, dst.port_no)):
+            if dpid in self.switches:
+                self.interior_ports[dpid].add(port_no)
+                self.update_access_ports(dpid)
+
+    def remove_link(self, src_dpid, dst_dpid):
+        ports = self.link_to_port.pop((src_dpid, dst_dpid), None)
+        if ports is None:
+            return
+        if self.graph.has_edge(src_dpid, dst_dpid):
+            self.graph.remove_edge(src_dpid, dst_dpid)
+            self.drop_flows_over_link(src_dpid, dst_dpid, ports[0])
+            self.invalidate_routes_link_removed(src_dpid, dst_dpid)
+            self.refresh_host_routes()
+        if self.FAILOVER:
+            hub.spawn_after(self.FAILOVER_CLEANUP_DELAY,
+                            self.cleanup_port, src_dpid, ports[0])
+
+        # A port stays interior while the reverse link still uses it
+        reverse = self.link_to_port.get((dst_dpid, src_dpid))
+        for dpid, port_no, index in ((src_dpid, ports[0], 1), (dst_dpid, ports[1], 0)):
+            if reverse is not None and reverse[index] == port_no:
+                continue
+            if dpid in self.interior_ports:
+                self.interior_ports[dpid].discard(port_no)
+                self.update_access_ports(dpid)
+
+    def drop_flows_over_link(self, src_dpid, dst_dpid, port_no):
+        """
+            Remove the per-flow rules forwarding over a link that went
+            away: every rule of the elephants whose path used it, and the
+            counting rules of src_dpid sending to its port. The flows
+            follow their ipv4_dst rules until they are split out again.
+        """
+        for flow, path in list(self.elephant_paths.items()):
+            if (src_dpid, dst_dpid) not in zip(path, path[1:]):
+                continue
+            del self.elephant_paths[flow]
+            self.flow_counters.pop(flow, None)
+            for dpid in path[:-1]:
+                dp = self.datapaths.get(dpid)
+                if dp is not None:
+                    self.delete_flow(dp, self.FLOW_PRIORITY, dp.ofproto_parser.OFPMatch(
+                        eth_type=ether_types.ETH_TYPE_IP, ipv4_src=flow[0], ipv4_dst=flow[1]))
+        dp = self.datapaths.get(src_dpid)
+        if dp is not None:
+            dead = self.actions_key([dp.ofproto_parser.OFPActionOutput(port_no)])
+            for (priority, items), (actions_key, _) in list(self.flow_table.get(src_dpid, {}).items()):
+                if priority == self.FLOW_PRIORITY and actions_key == dead:
+                    match = dict(items)
+                    self.flow_counters.pop((match.get('ipv4_src'), match.get('ipv4_dst')), None)
+                    self.delete_flow(dp, priority, dp.ofproto_parser.OFPMatch(**match))
+        self.flush_flows()
+
+    def cleanup_port(self, dpid, port_no):
+        """
+            Remove the flows and groups of dpid still sending to a port
+            whose link is gone. Fast-failover kept their traffic flowing
+            meanwhile, the recomputed routes take over from here.
+        """
+        dp = self.datapaths.get(dpid)
+        if dp is None:
+            return
+        for (src, _), ports in self.link_to_port.items():
+            if src == dpid and ports[0] == port_no:
+                # the link came back
+                return
+        ofproto = dp.ofproto
+        parser = dp.ofproto_parser
+        self.queue_msg(dp, parser.OFPFlowMod(
+            dp, command=ofproto.OFPFC_DELETE, table_id=ofproto.OFPTT_ALL,
+            out_port=port_no, out_group=ofproto.OFPG_ANY, match=parser.OFPMatch()))
+        # deleting a group also deletes the flows forwarding to it
+        groups = self.groups.get(dpid, {})
+        for key, group_id in list(groups.items()):
+            if port_no in key[1:]:
+                self.queue_msg(dp, parser.OFPGroupMod(
+                    dp, ofproto.OFPGC_DELETE, ofproto.OFPGT_ALL, group_id))
+                del groups[key]
+        self.flush_flows()
+
+    def port_down(self, dpid, port_no):
+        """
+            Forget the links and the host using a port that went down.
+        """
+        for (src, dst), (src_port, dst_port) in list(self.link_to_port.items()):
+            if (src, src_port) == (dpid, port_no) or (dst, dst_port) == (dpid, port_no):
+                self.remove_link(src, dst)
+        if (dpid, port_no) in self.access_table:
+            self.unregister_access_info((dpid, port_no))
+
+    def update_access_ports(self, dpid):
+        all_port_table = self.switch_port_table.get(dpid, set())
+        interior_port = self.interior_ports.get(dpid, set())
+        self.access_ports[dpid] = all_port_table - interior_port
+
     def get_graph(self):
-        link_list = get_all_link(self)
-        for link in link_list:
-            src_dpid = link.src.dpid
-            dst_dpid = link.dst.dpid
-            src_port = link.src.port_no
-            dst_port = link.dst.port_no
-            self.graph.add_edge(src_dpid, dst_dpid,
-                                src_port=src_port,
-                                dst_port=dst_port)
+        """
+            Bring the graph in line with the links known to the
+            topology app, adding and removing only what changed.
+        """
+        links = {}
+        for link in get_all_link(self):
+            links[(link.src.dpid, link.dst.dpid)] = link
+        for key in list(self.link_to_port):
+            if key not in links:
+                self.remove_link(*key)
+        for key, link in links.items():
+            if self.link_to_port.get(key) != (link.src.port_no, link.dst.port_no):
+                self.add_link(link)
         return self.graph
 
     def register_access_info(self, dpid, in_port, ip, mac):
         """
-            Register access host info into access table.
+            Register access host info into access table
+            and keep the ip/mac location indexes in sync.
         """
         # print "register " + ip
-        if in_port in self.access_ports[dpid]:
-            if (dpid, in_port) in self.access_table:
-                if self.access_table[(dpid, in_port)] == (ip, mac):
-                    return
-                else:
-                    self.access_table[(dpid, in_port)] = (ip, mac)
-                    return
-            else:
-                self.access_table.setdefault((dpid, in_port), None)
-                self.access_table[(dpid, in_port)] = (ip, mac)
-                return
+        if in_port not in self.access_ports.get(dpid, ()):
+            return
+        location = (dpid, in_port)
+        if self.access_table.get(location) == (ip, mac):
+            return
+
+        # Another host was attached to this port
+        if location in self.access_table:
+            self.unregister_access_info(location)
+
+        # The host moved, drop its previous location
+        for old in (self.ip_to_location.get(ip),
+                    self.mac_to_location.get(mac)):
+            if old is not None and old in self.access_table:
+                self.unregister_access_info(old)
+
+        self.access_table[location] = (ip, mac)
+        self.arp_table[ip] = mac
+        self.ip_to_location[ip] = location
+        self.mac_to_location[mac] = location
+
+        if self.PROACTIVE:
+            self.install_host_routes(ip)
+
+    def unregister_access_info(self, location):
+        """
+            Remove the host at location (dpid, port) from the access table.
+        """
+        ip, mac = self.access_table.pop(location)
+        if self.ip_to_location.get(ip) == location:
+            del self.ip_to_location[ip]
+        if self.mac_to_location.get(mac) == location:
+            del self.mac_to_location[mac]
 
     def get_host_location(self, host_ip):
         """
             Get host location info:(datapath, port) according to host ip.
         """
-        for key in self.access_table.keys():
-            if self.access_table[key][0] == host_ip:
-                return key
-        self.logger.debug("%s location is not found." % host_ip)
-        return None
-
+        location = self.ip_to_location.get(host_ip)
+        if location is None:
+            self.logger.debug("%s location is not found." % host_ip)
+        return location
 
     def get_datapath(self, dpid):
 
         if dpid not in self.dps:
-            switch = topo_api.get_switch(self, dpid)[0]
+            switch = get_switch(self, dpid)[0]
             self.dps[dpid] = switch.dp
             return switch.dp
         return self.dps[dpid]
 
-    def set_shortest_path(self, ip_src, ip_dst, src_dpid, dst_dpid, to_port_no, to_dst_match, pre_actions=[]):
-
-        if nx.has_path(self.graph, src_dpid, dst_dpid):
-            path = nx.shortest_path(self.graph, src_dpid, dst_dpid)
-        '''
+    def get_route(self, src_dpid, dst_dpid):
+        """
+            Get the cached shortest path between two switches, computing
+            the shortest paths from src_dpid to every switch on a miss.
+        """
+        paths = self.route_cache.get(src_dpid)
+        if paths is None:
+            self.route_misses += 1
+            if not self.graph.has_node(src_dpid):
+                return None
+            if self.WEIGHTED:
+                paths = nx.single_source_dijkstra_path(self.graph, src_dpid,
+                                                       weight='weight')
+            else:
+                paths = nx.single_source_shortest_path(self.graph, src_dpid)
+            self.route_cache[src_dpid] = paths
         else:
-            path = None
+            self.route_hits += 1
+
+        lookups = self.route_hits + self.route_misses
+        if lookups % self.ROUTE_STATS_INTERVAL == 0:
+            self.logger.info("route cache: %d hits, %d misses",
+                             self.route_hits, self.route_misses)
+        return paths.get(dst_dpid)
+
+    def path_cost(self, path):
+        """
+            Sum of the link weights along path, its hop count unless
+            SP_WEIGHTED is set.
+        """
+        return sum(self.graph[a][b].get('weight', 1) for a, b in zip(path, path[1:]))
+
+    def invalidate_routes_link_added(self, src_dpid, dst_dpid):
+        """
+            Drop the cached sources for which the new link is a shortcut.
+        """
+        for src, paths in list(self.route_cache.items()):
+            if src_dpid not in paths:
+                continue
+            weight = self.graph[src_dpid][dst_dpid].get('weight', 1)
+            if (dst_dpid not in paths or
+                    self.path_cost(paths[src_dpid]) + weight < self.path_cost(paths[dst_dpid])):
+                del self.route_cache[src]
+
+    def invalidate_routes_link_removed(self, src_dpid, dst_dpid):
+        """
+            Drop the cached sources whose shortest path tree used the link.
+        """
+        for src, paths in list(self.route_cache.items()):
+            path = paths.get(dst_dpid)
+            if path and len(path) > 1 and path[-2] == src_dpid:
+                del self.route_cache[src]
+
+    def install_host_routes(self, ip, flush=True):
+        """
+            Install the ipv4_dst rule toward a host on every switch,
+            following the shortest path tree rooted at its switch.
+        """
+        location = self.get_host_location(ip)
+        if location is None:
+            return
+        dst_dpid, dst_port = location
+        for dpid in list(self.switches):
+            dp = self.datapaths.get(dpid)
+            if dp is None:
+                continue
+            if dpid == dst_dpid:
+                ports = [dst_port]
+            else:
+                ports = self.next_hop_ports(dpid, dst_dpid)
+                if not ports:
+                    if self.COMPRESS:
+                        self.set_host_route(dpid, ip, None)
+                    continue
+            actions = self.output_actions(dp, ports, dst_dpid)
+            if self.COMPRESS:
+                self.set_host_route(dpid, ip, actions)
+                continue
+            parser = dp.ofproto_parser
+            match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP,
+                                    ipv4_dst=ip)
+            self.queue_flow(dp, 10, match, actions)
+        if flush:
+            self.compile_routes()
+            self.flush_flows()
+
+    def set_host_route(self, dpid, ip, actions):
+        """
+            Record the route of dpid toward ip (None for no route) for the
+            next compile_routes().
+        """
+        routes = self.host_routes.setdefault(dpid, {})
+        old = routes.get(ip)
+        if actions is None:
+            if old is not None:
+                del routes[ip]
+                self.dirty_routes.add(dpid)
+        elif old is None or self.actions_key(old) != self.actions_key(actions):
+            routes[ip] = actions
+            self.dirty_routes.add(dpid)
+
+    def compile_routes(self):
+        """
+            Replace the per-host rules of the switches whose routes changed
+            by their compiled prefixes, and log the rule counts.
+        """
+        if not self.dirty_routes:
+            return
+        for dpid in sorted(self.dirty_routes):
+            dp = self.datapaths.get(dpid)
+            if dp is None:
+                continue
+            parser = dp.ofproto_parser
+            routes = self.host_routes.get(dpid, {})
+            by_key = {rule_compiler.CONTROLLER: [parser.OFPActionOutput(
+                dp.ofproto.OFPP_CONTROLLER, dp.ofproto.OFPCML_NO_BUFFER)]}
+            hops = {}
+            for ip, actions in routes.items():
+                key = self.actions_key(actions)
+                by_key[key] = actions
+                hops[ip] = key
+            installed = self.prefix_rules.setdefault(dpid, {})
+            wanted = {}
+            for ip, mask, length, key in rule_compiler.compile_prefixes(hops, self.host_plan):
+                priority = self.PREFIX_PRIORITY + length
+                wanted[(ip, mask)] = priority
+                self.queue_flow(dp, priority, self.prefix_match(parser, ip, mask),
+                                by_key[key])
+            for (ip, mask), priority in list(installed.items()):
+                if wanted.get((ip, mask)) != priority:
+                    self.delete_flow(dp, priority, self.prefix_match(parser, ip, mask))
+            self.prefix_rules[dpid] = wanted
+            self.logger.info("switch %s: %d host rules compiled into %d prefixes",
+                             dpid, len(routes), len(wanted))
+        self.dirty_routes.clear()
+        self.logger.info("prefix rules: %d over %d switches, at most %d per switch",
+                         sum(len(rules) for rules in self.prefix_rules.values()),
+                         len(self.prefix_rules),
+                         max([len(rules) for rules in self.prefix_rules.values()] or [0]))
+
+    def prefix_match(self, parser, ip, mask):
+        # switches report full masks as exact matches
+        if mask == '255.255.255.255':
+            return parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP, ipv4_dst=ip)
+        return parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP,
+                               ipv4_dst=(ip, mask))
+
+    def delete_flow(self, dp, p, match):
+        """
+            Queue the removal of a flow entry and drop it from the shadow
+            table.
+        """
+        ofproto = dp.ofproto
+        parser = dp.ofproto_parser
+        self.flow_table.get(dp.id, {}).pop(self.rule_key(p, match), None)
+        self.queue_msg(dp, parser.OFPFlowMod(
+            dp, command=ofproto.OFPFC_DELETE_STRICT, priority=p,
+            out_port=ofproto.OFPP_ANY, out_group=ofproto.OFPG_ANY, match=match))
 
+    def refresh_host_routes(self):
+        """
+            Re-push the proactive routes after a topology change.
+        """
+        if self.PROACTIVE:
+            for ip in list(self.ip_to_location):
+                self.install_host_routes(ip, flush=False)
+            self.compile_routes()
+            self.flush_flows()
+
+    def set_shortest_path(self, ip_src, ip_dst, src_dpid, dst_dpid, to_port_no, to_dst_match, pre_actions=[]):
+
+        path = self.get_route(src_dpid, dst_dpid)
         if path is None:
             self.logger.info("Get path failed.")
-            return 0
-        '''
-        if self.get_host_location(ip_src)[0] == src_dpid:
+            return None
+
+        src_location = self.get_host_location(ip_src)
+        if src_location and src_location[0] == src_dpid:
 
             print ("path from " + ip_src + " to " + ip_dst +':')
             print (ip_src + ' ->')
@@ -352,23 +1337,145 @@ class SPRouter(app_manager.RyuApp):
                 print (str(sw) + ' ->')
             print (ip_dst)
         
+        # Queue the rules from the destination backward, the caller
+        # flushes them
+        dst_dp = self.get_datapath(dst_dpid)
+        actions = [dst_dp.ofproto_parser.OFPActionOutput(to_port_no)]
+        self.queue_dst_flow(dst_dp, to_dst_match, pre_actions+actions)
         if len(path) == 1:
-            dp = self.get_datapath(src_dpid)
-            actions = [dp.ofproto_parser.OFPActionOutput(to_port_no)]
-            self.add_flow(dp, 10, to_dst_match, pre_actions+actions)
             port_no = to_port_no
+        elif self.ECMP:
+            port_no = self.install_ecmp(to_dst_match, src_dpid, dst_dpid, pre_actions)
         else:
             self.install_path(to_dst_match, path, pre_actions)
-            dst_dp = self.get_datapath(dst_dpid)
-            actions = [dst_dp.ofproto_parser.OFPActionOutput(to_port_no)]
-            self.add_flow(dst_dp,  10, to_dst_match, pre_actions+actions)
             port_no = self.graph[path[0]][path[1]]['src_port']
 
         return port_no
 
+    def next_hop_ports(self, dpid, dst_dpid):
+        """
+            Output ports of dpid toward dst_dpid: every equal-cost next
+            hop with ECMP, the next hop of the cached route otherwise.
+        """
+        path = self.get_route(dpid, dst_dpid)
+        if path is None or len(path) < 2:
+            return []
+        if not self.ECMP:
+            return [self.graph[dpid][path[1]]['src_port']]
+        ports = []
+        cost = self.path_cost(path)
+        for nbr in self.graph.successors(dpid):
+            nbr_path = self.get_route(nbr, dst_dpid)
+            if nbr_path is None:
+                continue
+            nbr_cost = self.graph[dpid][nbr].get('weight', 1) + self.path_cost(nbr_path)
+            if abs(nbr_cost - cost) < 1e-9:
+                ports.append(self.graph[dpid][nbr]['src_port'])
+        return sorted(ports)
+
+    def backup_ports(self, dpid, dst_dpid, primary):
+        """
+            Ports of dpid toward loop-free alternates for dst_dpid: the
+            neighbours whose own route to dst_dpid is shorter than going
+            back through dpid, best first.
+        """
+        path = self.get_route(dpid, dst_dpid)
+        if path is None:
+            return []
+        cost = self.path_cost(path)
+        alternates = []
+        for nbr in self.graph.successors(dpid):
+            port_no = self.graph[dpid][nbr]['src_port']
+            if port_no == primary:
+                continue
+            nbr_path = self.get_route(nbr, dst_dpid)
+            back_path = self.get_route(nbr, dpid)
+            if nbr_path is None or back_path is None:
+                continue
+            nbr_cost = self.path_cost(nbr_path)
+            if nbr_cost < self.path_cost(back_path) + cost:
+                alternates.append((self.graph[dpid][nbr].get('weight', 1) + nbr_cost, port_no))
+        return [port_no for _, port_no in sorted(alternates)]
+
+    def output_actions(self, dp, ports, dst_dpid=None):
+        """
+            Send to a single port, or hash over several with a select group.
+            With SP_FAILOVER and SP_PROACTIVE a single port toward dst_dpid
+            is backed by its loop-free alternates through a fast-failover
+            group; select groups skip dead ports by themselves.
+        """
+        parser = dp.ofproto_parser
+        if len(ports) == 1:
+            backups = []
+            if self.FAILOVER and self.PROACTIVE and dst_dpid is not None:
+                backups = self.backup_ports(dp.id, dst_dpid, ports[0])
+            if not backups:
+                return [parser.OFPActionOutput(ports[0])]
+            group_id = self.get_group(dp, dp.ofproto.OFPGT_FF, ports + backups)
+            return [parser.OFPActionGroup(group_id)]
+        return [parser.OFPActionGroup(
+            self.get_group(dp, dp.ofproto.OFPGT_SELECT, ports))]
+
+    def get_group(self, dp, group_type, ports):
+        """
+            Get the id of the group of dp of group_type over ports, in
+            order, queueing its creation the first time. Ids are never
+            reused, even after the group is deleted.
+        """
+        groups = self.groups.setdefault(dp.id, {})
+        key = (group_type,) + tuple(ports)
+        if key not in groups:
+            ofproto = dp.ofproto
+            parser = dp.ofproto_parser
+            group_id = self.last_group_id.get(dp.id, 0) + 1
+            self.last_group_id[dp.id] = group_id
+            weight = 1 if group_type == ofproto.OFPGT_SELECT else 0
+            buckets = [parser.OFPBucket(weight=weight, watch_port=port,
+                                        watch_group=ofproto.OFPG_ANY,
+                                        actions=[parser.OFPActionOutput(port)])
+                       for port in ports]
+            self.queue_msg(dp, parser.OFPGroupMod(
+                dp, ofproto.OFPGC_ADD, group_type, group_id, buckets))
+            groups[key] = group_id
+        return groups[key]
+
+    def install_ecmp(self, match, src_dpid, dst_dpid, pre_actions=[]):
+        """
+            Install match on every switch of every shortest path from
+            src_dpid to dst_dpid, from the destination backward, and
+            return the first output port of src_dpid.
+        """
+        next_hops = {}
+        frontier = [src_dpid]
+        while frontier:
+            dpid = frontier.pop()
+            if dpid in next_hops or dpid == dst_dpid:
+                continue
+            next_hops[dpid] = self.next_hop_ports(dpid, dst_dpid)
+            for nbr in self.graph.successors(dpid):
+                if self.graph[dpid][nbr]['src_port'] in next_hops[dpid]:
+                    frontier.append(nbr)
+
+        for dpid in sorted(next_hops, key=lambda d: self.path_cost(self.get_route(d, dst_dpid))):
+            dp = self.get_datapath(dpid)
+            actions = self.output_actions(dp, next_hops[dpid], dst_dpid)
+            self.queue_dst_flow(dp, match, pre_actions+actions)
+        return next_hops[src_dpid][0]
+
     def install_path(self, match, path, pre_actions=[]):
-        for index, dpid in enumerate(path[:-1]):
+        for index in range(len(path) - 2, -1, -1):
+            dpid = path[index]
             port_no = self.graph[path[index]][path[index + 1]]['src_port']
             dp = self.get_datapath(dpid)
-            actions = [dp.ofproto_parser.OFPActionOutput(port_no)]
-            self.add_flow(dp, 10, match, pre_actions+actions)
+            actions = self.output_actions(dp, [port_no], path[-1])
+            self.queue_dst_flow(dp, match, pre_actions+actions)
+
+    def queue_dst_flow(self, dp, match, actions):
+        """
+            Queue the ipv4_dst rule of a reactive route, or record it as a
+            host route for the next compile_routes() with SP_COMPRESS.
+        """
+        if self.COMPRESS:
+            self.set_host_route(dp.id, match['ipv4_dst'], actions)
+        else:
+            self.queue_flow(dp, 10, match, actions)
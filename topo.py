@@ -16,110 +16,748 @@
 # under the License.
 
 import sys
+import heapq
 import random
 import queue
 import math
+import mmap
+import struct
+from statistics import NormalDist
+from array import array
+from collections import deque
+from collections.abc import Sequence
+from multiprocessing import Pool
 
-# Class for an edge in the graph
-class Edge:
+# Translation table turning a 0/1 node mask into its complement
+INVERT_MASK = bytes([1]) + bytes(255)
+
+# Number of set bits of a bitmask
+popcount = getattr(int, "bit_count", None) or (lambda x: bin(x).count("1"))
+
+# Compact adjacency store shared by all the nodes of a topology.
+# Nodes are integer indices. The neighbours of every node sit in one
+# flat CSR pair of arrays, targets[offsets[u]:offsets[u + 1]], with a
+# parallel flags bytearray that is 1 where the link was added as
+# (lnode=u, rnode=v). A mutation copies the neighbours of the nodes it
+# touches to an overflow dict, which compact() folds back into the flat
+# arrays. Node views are only built when they are accessed.
+#
+# Every mutation is reported to the subscribers as callback(event, u, v)
+# with event one of "add_node", "remove_node" (v is None), "add_link",
+# "remove_link", "fail_link" or "restore_link".
+class Graph:
 	def __init__(self):
-		self.lnode = None
-		self.rnode = None
-	
+		self.ids = StringList()
+		self.types = TypeList()
+		self.nodes = LazyList(0, lambda i: Node(self, i))
+		self.adj = Adjacency(self)
+		self.offsets = array('I', [0])
+		self.targets = array('i')
+		self.flags = bytearray()
+		self.overflow = {}
+		self.keys = None
+		self.failed = set()
+		self.removed = set()
+		self.num_links = 0
+		self.subscribers = []
+
+	# Register a callback(event, u, v) called after every mutation
+	def subscribe(self, callback):
+		self.subscribers.append(callback)
+
+	def unsubscribe(self, callback):
+		self.subscribers.remove(callback)
+
+	def notify(self, event, u, v=None):
+		for callback in self.subscribers:
+			callback(event, u, v)
+
+	def __len__(self):
+		return len(self.ids)
+
+	# Add a node and return its Node view
+	def add_node(self, id, type):
+		index = self.add_nodes((id,), type)[0]
+		return self.nodes[index]
+
+	# Add a node per id, all of the same type, and return the range of
+	# their indices without building their Node views
+	def add_nodes(self, ids, type):
+		start = len(self.ids)
+		ids = list(ids)
+		if not isinstance(self.offsets, array):
+			self.offsets = array('I', self.offsets)
+		self.ids.extend(ids)
+		self.types.extend([type] * len(ids))
+		self.nodes.extend([None] * len(ids))
+		self.offsets.extend([self.offsets[-1]] * len(ids))
+		if self.subscribers:
+			for index in range(start, len(self.ids)):
+				self.notify("add_node", index)
+		return range(start, len(self.ids))
+
+	# Remove the node u and all of its links. Node indices are never
+	# reused, u is only marked as removed
+	def remove_node(self, u):
+		for v in list(self.adj[u]):
+			self.remove_edge(u, v)
+		self.failed = set(key for key in self.failed
+		                  if key >> 32 != u and key & 0xffffffff != u)
+		self.removed.add(u)
+		if self.subscribers:
+			self.notify("remove_node", u)
+
+	# Neighbours of u and their orientation flags, moved to the overflow
+	# so that they can be changed
+	def _mutable(self, u):
+		entry = self.overflow.get(u)
+		if entry is None:
+			a, b = self.offsets[u], self.offsets[u + 1]
+			entry = (array('i', self.targets[a:b]), bytearray(self.flags[a:b]))
+			self.overflow[u] = entry
+		return entry
+
+	# Append the link u-v to both neighbour lists, oriented as (u, v)
+	def _link(self, u, v):
+		overflow = self.overflow
+		nbrs, flags = overflow.get(u) or self._mutable(u)
+		nbrs.append(v)
+		flags.append(1)
+		if u != v:
+			nbrs, flags = overflow.get(v) or self._mutable(v)
+			nbrs.append(u)
+			flags.append(0)
+		if self.keys is not None:
+			self.keys.add((u << 32) | v)
+		self.num_links += 1
+
+	# Add an undirected link between the nodes u and v. Adding a link
+	# that exists is a no-op; a failed link comes back with restore_edge
+	def add_edge(self, u, v):
+		if v in self.neighbors(u):
+			return
+		if self.failed and (((u << 32) | v) in self.failed or ((v << 32) | u) in self.failed):
+			raise ValueError("link %d-%d is failed, restore it instead" % (u, v))
+		self._link(u, v)
+		if self.subscribers:
+			self.notify("add_link", u, v)
+
+	# Remove the undirected link between the nodes u and v and return its
+	# packed (lnode << 32) | rnode key
+	def remove_edge(self, u, v, event="remove_link"):
+		if not self.has_edge(u, v):
+			raise KeyError("no link %d-%d" % (u, v))
+		nbrs, flags = self._mutable(u)
+		i = nbrs.index(v)
+		key = (u << 32) | v if flags[i] else (v << 32) | u
+		del nbrs[i]
+		del flags[i]
+		if u != v:
+			nbrs, flags = self._mutable(v)
+			i = nbrs.index(u)
+			del nbrs[i]
+			del flags[i]
+		self.keys.discard(key)
+		self.num_links -= 1
+		if self.subscribers:
+			self.notify(event, u, v)
+		return key
+
+	# Take the link u-v down; it disappears from the adjacency until
+	# restore_edge brings it back with its original orientation
+	def fail_edge(self, u, v):
+		self.failed.add(self.remove_edge(u, v, "fail_link"))
+
+	def restore_edge(self, u, v):
+		key = (u << 32) | v
+		if key not in self.failed:
+			key = (v << 32) | u
+		self.failed.remove(key)
+		if self.has_edge(u, v):
+			return
+		u, v = key >> 32, key & 0xffffffff
+		self._link(u, v)
+		if self.subscribers:
+			self.notify("restore_link", u, v)
+
+	# Packed (lnode << 32) | rnode key of every link, for O(1) membership.
+	# The set costs several times the CSR arrays, so it is only built on
+	# the first lookup, kept up to date while the graph is mutated and
+	# dropped again by compact()
+	def link_keys(self):
+		keys = self.keys
+		if keys is None:
+			keys = set()
+			overflow, offsets, targets, flags = self.overflow, self.offsets, self.targets, self.flags
+			for u in range(len(self.ids)):
+				entry = overflow.get(u)
+				if entry is None:
+					a, b = offsets[u], offsets[u + 1]
+					nbrs, oriented = targets[a:b], flags[a:b]
+				else:
+					nbrs, oriented = entry
+				for v, flag in zip(nbrs, oriented):
+					if flag:
+						keys.add((u << 32) | v)
+			self.keys = keys
+		return keys
+
+	# Decide if the nodes u and v are neighbors
+	def has_edge(self, u, v):
+		keys = self.keys if self.keys is not None else self.link_keys()
+		return ((u << 32) | v) in keys or ((v << 32) | u) in keys
+
+	# Decide if the link u-v was added as (lnode=u, rnode=v)
+	def is_oriented(self, u, v):
+		keys = self.keys if self.keys is not None else self.link_keys()
+		return ((u << 32) | v) in keys
+
+	# Every link as a packed (lnode << 32) | rnode key, built on demand
+	@property
+	def links(self):
+		offsets, targets = self.csr()
+		flags = self.flags
+		links = set()
+		for u in range(len(offsets) - 1):
+			for i in range(offsets[u], offsets[u + 1]):
+				if flags[i]:
+					links.add((u << 32) | targets[i])
+		return links
+
+	def degree(self, u):
+		return len(self.neighbors(u))
+
+	def neighbors(self, u):
+		entry = self.overflow.get(u)
+		if entry is not None:
+			return entry[0]
+		return self.targets[self.offsets[u]:self.offsets[u + 1]]
+
+	# Fold the overflow back into the flat arrays
+	def compact(self):
+		overflow = self.overflow
+		if not overflow:
+			return
+		old_offsets, old_targets, old_flags = self.offsets, self.targets, self.flags
+		offsets = array('I', [0])
+		targets = array('i')
+		flags = bytearray()
+		for u in range(len(self.ids)):
+			entry = overflow.get(u)
+			if entry is None:
+				a, b = old_offsets[u], old_offsets[u + 1]
+				targets.extend(old_targets[a:b])
+				flags.extend(old_flags[a:b])
+			else:
+				targets.extend(entry[0])
+				flags.extend(entry[1])
+			offsets.append(len(targets))
+		self.offsets, self.targets, self.flags = offsets, targets, flags
+		overflow.clear()
+		self.keys = None
+
+	# Return the adjacency in CSR form: the neighbours of u are
+	# targets[offsets[u]:offsets[u + 1]]
+	def csr(self):
+		self.compact()
+		return self.offsets, self.targets
+
+	# Breadth-first search from the node src over the nodes with an index
+	# lower than limit (all of them by default) and, if given, a non-zero
+	# entry in the allowed bytearray. Returns the hop distance (-1 if
+	# unreachable) and the predecessor (-1 for none) of every node
+	def bfs(self, src, limit=None, allowed=None):
+		offsets, targets = self.csr()
+		# slices of a memoryview are not copies
+		targets = memoryview(targets)
+		n = len(offsets) - 1 if limit is None else limit
+		dist = array('i', [-1]) * n
+		prec = array('i', [-1]) * n
+		if allowed is None:
+			visited = bytearray(n)
+		else:
+			# visited starts as the mask of the nodes not allowed
+			visited = bytearray(allowed[:n]).translate(INVERT_MASK)
+		visited[src] = 1
+		dist[src] = 0
+		frontier = deque((src,))
+		while frontier:
+			u = frontier.popleft()
+			d = dist[u] + 1
+			for v in targets[offsets[u]:offsets[u + 1]]:
+				if v < n and not visited[v]:
+					visited[v] = 1
+					dist[v] = d
+					prec[v] = u
+					frontier.append(v)
+		return dist, prec
+
+	# Shortest path from src to dst as a list of nodes, None if there is
+	# none. The search stays on the nodes below limit (with a non-zero
+	# entry in allowed if given) that are not in banned_nodes and skips
+	# the links u->v whose (u << 32) | v key is in banned_links
+	def shortest_path(self, src, dst, limit=None, banned_nodes=(), banned_links=(), allowed=None):
+		offsets, targets = self.csr()
+		n = len(offsets) - 1 if limit is None else limit
+		prec = {src: -1}
+		for u in banned_nodes:
+			prec.setdefault(u, None)
+		frontier = deque((src,))
+		while frontier and dst not in prec:
+			u = frontier.popleft()
+			for v in targets[offsets[u]:offsets[u + 1]]:
+				if (v < n and v not in prec and (allowed is None or allowed[v])
+				    and ((u << 32) | v) not in banned_links):
+					prec[v] = u
+					frontier.append(v)
+		if prec.get(dst) is None and dst != src:
+			return None
+		path = [dst]
+		while path[-1] != src:
+			path.append(prec[path[-1]])
+		path.reverse()
+		return path
+
+	# Yen's algorithm: up to k loopless paths from src to dst over the
+	# nodes below limit (and in allowed), shortest first
+	def k_shortest_paths(self, src, dst, k, limit=None, allowed=None):
+		first = self.shortest_path(src, dst, limit, allowed=allowed)
+		if first is None:
+			return []
+		paths = [first]
+		candidates = []
+		seen = {tuple(first)}
+		while len(paths) < k:
+			prev = paths[-1]
+			for j in range(len(prev) - 1):
+				root = prev[:j + 1]
+				banned_links = set((p[j] << 32) | p[j + 1] for p in paths
+				                   if len(p) > j + 1 and p[:j + 1] == root)
+				spur = self.shortest_path(prev[j], dst, limit, root[:-1], banned_links, allowed)
+				if spur is None:
+					continue
+				path = root[:-1] + spur
+				if tuple(path) not in seen:
+					seen.add(tuple(path))
+					heapq.heappush(candidates, (len(path), path))
+			if not candidates:
+				break
+			paths.append(heapq.heappop(candidates)[1])
+		return paths
+
+	# Batched BFS from all the nodes with an index lower than limit at
+	# once. Sets of sources are bitmasks held in Python ints and the
+	# frontiers of every source advance together one hop per round, so
+	# layers[d][u] is the set of sources at exactly d hops from u
+	def distance_layers(self, limit=None):
+		offsets, targets = self.csr()
+		n = len(offsets) - 1 if limit is None else limit
+		frontier = [1 << u for u in range(n)]
+		reached = frontier[:]
+		layers = [frontier]
+		while True:
+			nxt = [0] * n
+			grown = False
+			for u in range(n):
+				acc = 0
+				for v in targets[offsets[u]:offsets[u + 1]]:
+					if v < n:
+						acc |= frontier[v]
+				acc &= ~reached[u]
+				if acc:
+					nxt[u] = acc
+					reached[u] |= acc
+					grown = True
+			if not grown:
+				break
+			layers.append(nxt)
+			frontier = nxt
+		return layers
+
+# Class for an edge in the graph, a view on a link of a Graph
+class Edge:
+	__slots__ = ('lnode', 'rnode')
+
+	def __init__(self, lnode=None, rnode=None):
+		self.lnode = lnode
+		self.rnode = rnode
+
 	def remove(self):
-		self.lnode.edges.remove(self)
-		self.rnode.edges.remove(self)
+		self.lnode.graph.remove_edge(self.lnode.index, self.rnode.index)
 		self.lnode = None
 		self.rnode = None
 
-# Class for a node in the graph
+# Class for a node in the graph, a view on a node of a Graph
 class Node:
-	def __init__(self, id, type):
-		self.edges = []
-		self.id = id
-		self.type = type
+	__slots__ = ('graph', 'index')
+
+	def __init__(self, graph, index):
+		self.graph = graph
+		self.index = index
+
+	@property
+	def id(self):
+		return self.graph.ids[self.index]
+
+	@property
+	def type(self):
+		return self.graph.types[self.index]
+
+	# Edges connected to the node, oriented as they were added
+	@property
+	def edges(self):
+		graph = self.graph
+		edges = []
+		for n in graph.adj[self.index]:
+			if graph.is_oriented(self.index, n):
+				edges.append(Edge(self, graph.nodes[n]))
+			else:
+				edges.append(Edge(graph.nodes[n], self))
+		return edges
 
 	# Add an edge connected to another node
 	def add_edge(self, node):
-		edge = Edge()
-		edge.lnode = self
-		edge.rnode = node
-		self.edges.append(edge)
-		node.edges.append(edge)
-		return edge
+		self.graph.add_edge(self.index, node.index)
+		return Edge(self, node)
 
 	# Remove an edge from the node
 	def remove_edge(self, edge):
-		self.edges.remove(edge)
+		self.graph.remove_edge(edge.lnode.index, edge.rnode.index)
 
 	# Decide if another node is a neighbor
 	def is_neighbor(self, node):
-		for edge in self.edges:
-			if edge.lnode == node or edge.rnode == node:
+		return self.graph.has_edge(self.index, node.index)
+
+# Cache of BFS results per source node on a Graph, restricted to the node
+# types given. It follows the mutations of the graph and only drops the
+# sources whose results a mutation can change: a link going away matters
+# only if it is on the BFS tree of the source, a new link only if it
+# joins nodes more than one hop apart from the source
+class PathCache:
+	def __init__(self, graph, types=("switch", "core_switch")):
+		self.graph = graph
+		self.types = set(types)
+		self.allowed = bytearray(t in self.types for t in graph.types)
+		for u in graph.removed:
+			self.allowed[u] = 0
+		self.results = {}
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+		graph.subscribe(self.on_change)
+
+	# Stop following the graph and drop every result
+	def close(self):
+		self.graph.unsubscribe(self.on_change)
+		self.results.clear()
+
+	# Distance and predecessor arrays of the BFS from the node src
+	def bfs(self, src):
+		result = self.results.get(src)
+		if result is None:
+			self.misses += 1
+			result = self.graph.bfs(src, allowed=self.allowed)
+			self.results[src] = result
+		else:
+			self.hits += 1
+		return result
+
+	def distance(self, src, dst):
+		return self.bfs(src)[0][dst]
+
+	# Nodes on the path from src to dst, [] if dst is unreachable
+	def path(self, src, dst):
+		dist, prec = self.bfs(src)
+		if dist[dst] < 0:
+			return []
+		path = [dst]
+		while path[-1] != src:
+			path.append(prec[path[-1]])
+		path.reverse()
+		return path
+
+	def invalidate(self, src):
+		del self.results[src]
+		self.invalidations += 1
+
+	def on_change(self, event, u, v):
+		if event == "add_node":
+			self.allowed.append(self.graph.types[u] in self.types)
+			for dist, prec in self.results.values():
+				dist.append(-1)
+				prec.append(-1)
+		elif event == "remove_node":
+			self.allowed[u] = 0
+		elif not (self.allowed[u] and self.allowed[v]):
+			return
+		elif event in ("remove_link", "fail_link"):
+			for src, (dist, prec) in list(self.results.items()):
+				if prec[v] == u or prec[u] == v:
+					self.invalidate(src)
+		else:
+			for src, (dist, prec) in list(self.results.items()):
+				du, dv = dist[u], dist[v]
+				if du != dv and (du < 0 or dv < 0 or abs(du - dv) > 1):
+					self.invalidate(src)
+
+# Graph of the k-shortest-paths workers, set up once per process
+_ksp_worker = None
+
+def _ksp_init(offsets, targets, allowed, k):
+	global _ksp_worker
+	graph = Graph()
+	graph.offsets = offsets
+	graph.targets = targets
+	_ksp_worker = (graph, allowed, k)
+
+def _ksp_source(job):
+	src, dsts = job
+	graph, allowed, k = _ksp_worker
+	return src, {dst: graph.k_shortest_paths(src, dst, k, allowed=allowed) for dst in dsts}
+
+# Cache of the k shortest paths (Yen, by hop count) per (src, dst) pair of
+# nodes of a Graph, restricted to the node types given. Pairs can be
+# computed ahead in parallel, one source node per task. A link going
+# away only drops the pairs with a path over it; a new link can shorten
+# any path and drops everything
+class KPathCache:
+	def __init__(self, graph, k, types=("switch", "core_switch")):
+		self.graph = graph
+		self.k = k
+		self.types = set(types)
+		self.allowed = bytearray(t in self.types for t in graph.types)
+		for u in graph.removed:
+			self.allowed[u] = 0
+		self.results = {}
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+		graph.subscribe(self.on_change)
+
+	def close(self):
+		self.graph.unsubscribe(self.on_change)
+		self.results.clear()
+
+	# The k shortest paths from src to dst as lists of nodes
+	def paths(self, src, dst):
+		result = self.results.get((src, dst))
+		if result is None:
+			self.misses += 1
+			result = self.graph.k_shortest_paths(src, dst, self.k, allowed=self.allowed)
+			self.results[(src, dst)] = result
+		else:
+			self.hits += 1
+		return result
+
+	# Compute the missing (src, dst) pairs on a pool of processes (one per
+	# core by default), one task per source node
+	def precompute(self, pairs, processes=None):
+		by_source = {}
+		for src, dst in pairs:
+			if (src, dst) not in self.results:
+				by_source.setdefault(src, set()).add(dst)
+		if not by_source:
+			return
+		jobs = [(src, sorted(dsts)) for src, dsts in by_source.items()]
+		offsets, targets = self.graph.csr()
+		init = (array('I', offsets), array('i', targets), bytes(self.allowed), self.k)
+		with Pool(processes, _ksp_init, init) as pool:
+			for src, paths in pool.imap_unordered(_ksp_source, jobs, chunksize=1):
+				for dst, result in paths.items():
+					self.results[(src, dst)] = result
+					self.misses += 1
+
+	# Number of distinct paths over every link, as {packed link key: count},
+	# among the k shortest paths of the (src, dst) pairs given, each pair
+	# counted once. Links between allowed nodes no path uses count 0
+	def link_path_counts(self, pairs):
+		counts = {key: 0 for key in self.graph.links
+		          if self.allowed[key >> 32] and self.allowed[key & 0xffffffff]}
+		for src, dst in set(pairs):
+			for path in self.paths(src, dst):
+				for u, v in zip(path, path[1:]):
+					key = (u << 32) | v
+					if key not in counts:
+						key = (v << 32) | u
+					counts[key] += 1
+		return counts
+
+	def invalidate(self, pair):
+		del self.results[pair]
+		self.invalidations += 1
+
+	def on_change(self, event, u, v):
+		if event == "add_node":
+			self.allowed.append(self.graph.types[u] in self.types)
+		elif event == "remove_node":
+			self.allowed[u] = 0
+		elif not (self.allowed[u] and self.allowed[v]):
+			return
+		elif event in ("remove_link", "fail_link"):
+			for pair, result in list(self.results.items()):
+				if any(self.path_uses(path, u, v) for path in result):
+					self.invalidate(pair)
+		else:
+			self.invalidations += len(self.results)
+			self.results.clear()
+
+	@staticmethod
+	def path_uses(path, u, v):
+		for a, b in zip(path, path[1:]):
+			if (a == u and b == v) or (a == v and b == u):
 				return True
 		return False
 
 class Jellyfish:
 
-	def __init__(self, num_servers, num_switches, num_ports):
+	# seed gives the instance its own random generator; without it the
+	# global random module state is used
+	def __init__(self, num_servers, num_switches, num_ports, seed=None):
+		self.rng = random if seed is None else random.Random(seed)
+		self.graph = Graph()
 		self.servers = []
 		self.switches = []
 		self.num_servers=num_servers
 		self.num_switches=num_switches
 		self.num_ports=num_ports
+		self.layers=None
 		self.generate()
+		self.graph.subscribe(self.on_change)
+
+	#drop the all-pairs switch distances when the switch graph changes
+	def on_change(self,event,u,v):
+		if event!="add_node":
+			self.layers=None
 
 	#method to generate servers
 	def generateServers(self):
-		serv_to_conn=[]
-		for i in range(0, self.num_servers):
-			server = Node(str(i), "server")
-			self.servers.append(server)
-			serv_to_conn.append(server)
-		return serv_to_conn
+		indices=self.graph.add_nodes([str(i) for i in range(self.num_servers)],"server")
+		self.servers=NodeList(self.graph,indices)
+		return list(indices)
 
 	#method to generate switches
 	def generateSwitches(self,s):
-		sw_to_conn=[]
-		free_p=[]
-		for i in range(0, self.num_switches):
-			switch = Node(str(i), "switch")
-			self.switches.append(switch)
-			sw_to_conn.append(switch)
-			free_p.append(s)
-
-		return sw_to_conn,free_p
-
-	#method for incorporate a link
-	def remover(self,r,free_p, ind_A,sw_A):
-		ind_C = random.randint(0, self.num_switches - 1)
-		sw_C = self.switches[ind_C]
-		rand_conn = random.randint(0, r - 1)
-		edge_to_remove = sw_C.edges[rand_conn]
-		sw_A.add_edge(edge_to_remove.lnode)
-		sw_A.add_edge(edge_to_remove.rnode)
-		free_p[ind_A] = free_p[ind_A] - 2
-		sw_C.remove_edge(edge_to_remove)
-		return free_p
+		indices=self.graph.add_nodes([str(i) for i in range(self.num_switches)],"switch")
+		self.switches=NodeList(self.graph,indices)
+		return list(indices),[s]*self.num_switches
+
+	#method to pick a random switch-to-switch link, as an index into links
+	def random_link(self,links):
+		return self.rng.randrange(len(links))
+
+	#method to replace the link at position i of links by the links a-x and
+	#b-y, where (x, y) are its endpoints in either order
+	def swap_link(self,links,i,a,b,swap_ends):
+		x,y=links[i]
+		if swap_ends:
+			x,y=y,x
+		self.graph.remove_edge(x,y)
+		links[i]=links[-1]
+		links.pop()
+		for u,v in ((a,x),(b,y)):
+			self.graph.add_edge(u,v)
+			links.append((u,v))
+
+	#method to fill the free ports left by the random matching. Two
+	#non-adjacent switches with free ports are linked directly; otherwise
+	#a switch with two free ports, or two adjacent switches with one free
+	#port each, take over the endpoints of a random existing link (edge
+	#swap). A switch that finds no swap stays a partner for the others
+	def fix_free_ports(self,free_p,links,max_retries):
+		graph=self.graph
+		given_up=set()
+		while links:
+			pending=[sw for sw in range(self.num_switches) if free_p[sw]]
+
+			#direct links between pending switches
+			linked=False
+			for i,a in enumerate(pending):
+				for b in pending[i+1:]:
+					if free_p[a] and free_p[b] and not graph.has_edge(a,b):
+						graph.add_edge(a,b)
+						links.append((a,b))
+						free_p[a]-=1
+						free_p[b]-=1
+						linked=True
+			if linked:
+				continue
+
+			a=next((sw for sw in pending if sw not in given_up),None)
+			if a is None:
+				break
+			partners=[sw for sw in pending if sw!=a]
+			if free_p[a]>=2:
+				partners.append(a)
+			if not partners:
+				given_up.add(a)
+				continue
+
+			for _ in range(max_retries):
+				b=self.rng.choice(partners)
+				i=self.random_link(links)
+				swap_ends=self.rng.random()<0.5
+				x,y=links[i][::-1] if swap_ends else links[i]
+				if x in (a,b) or y in (a,b):
+					continue
+				if graph.has_edge(a,x) or graph.has_edge(b,y):
+					continue
+				self.swap_link(links,i,a,b,swap_ends)
+				free_p[a]-=1
+				free_p[b]-=1
+				given_up.clear()
+				break
+			else:
+				#give up on starting from this switch
+				given_up.add(a)
+
+	#method to connect the switches by random matching of their port stubs
+	#and return the number of ports that could not be matched
+	def connect_switches(self,free_p,max_retries=100):
+		graph=self.graph
+		links=[]
+		stubs=[sw for sw in range(self.num_switches) for _ in range(free_p[sw])]
+
+		#pair shuffled stubs; stubs that would form a self-loop or a
+		#parallel link are reshuffled for another round
+		for _ in range(max_retries):
+			if len(stubs)<2:
+				break
+			self.rng.shuffle(stubs)
+			left=stubs[len(stubs)//2*2:]
+			for i in range(0,len(stubs)-1,2):
+				a,b=stubs[i],stubs[i+1]
+				if a==b or graph.has_edge(a,b):
+					left.append(a)
+					left.append(b)
+				else:
+					graph.add_edge(a,b)
+					links.append((a,b))
+					free_p[a]-=1
+					free_p[b]-=1
+			if len(left)==len(stubs):
+				break
+			stubs=left
+
+		self.fix_free_ports(free_p,links,max_retries)
+		return sum(free_p)
 
 	#method to connect servers to switches
 	def connectServer(self,remaining_servers,r,servers_to_conn):
 		for i in range(0, self.num_switches):
 			for n in range(0, r):
 				if(remaining_servers == 0):
-					ind_A = random.randint(0, self.num_servers - 1)
-					to_conn = self.servers[ind_A]
+					ind_A = self.rng.randint(0, self.num_servers - 1)
+					to_conn = self.servers.indices[ind_A]
 				elif(remaining_servers > 0):
-					ind_A = random.randint(0, remaining_servers - 1)
+					ind_A = self.rng.randint(0, remaining_servers - 1)
 					remaining_servers = remaining_servers - 1
 					to_conn = servers_to_conn[ind_A]
 					servers_to_conn.pop(ind_A)
-				if(not self.switches[i].is_neighbor(to_conn)):
-					self.switches[i].add_edge(to_conn)
+				if(not self.graph.has_edge(i, to_conn)):
+					self.graph.add_edge(i, to_conn)
 
 	#generation of the topology
 	def generate(self):
-		# TODO: code for generating the jellyfish topology
 
 		#Calculate number of ports used to connect servers
 		r = math.ceil(self.num_servers / self.num_switches)
@@ -127,157 +765,182 @@ class Jellyfish:
 		#calculate number of ports for switches
 		s = self.num_ports - r
 
-		remaining = self.num_switches
-		remaining_servers = self.num_servers
+		#switches are added first so that switch i is graph node i
+		sw_to_conn,free_p = self.generateSwitches(s)
+		serv_to_conn=self.generateServers()
 
-		serv_to_conn=[]
-		switches_to_conn=[]
-		free_p=[]
+		#switch ports left free once the wiring is done
+		self.unmatched_ports=self.connect_switches(free_p)
 
-		serv_to_conn=self.generateServers()
-		sw_to_conn,free_p = self.generateSwitches(s)
+		self.connectServer(self.num_servers,r,serv_to_conn)
+		self.graph.compact()
 
-	
-		while sw_to_conn:
-			
-			ind_A = random.randint(0, remaining - 1)
+		return
 
-			if ((remaining == 1) and (free_p[ind_A] == 1)):
-				break
-			
-			if ((remaining == 1) and (free_p[ind_A] >= 2)):
+	#free ports of every switch once the switches are wired
+	def free_switch_ports(self):
+		s=self.num_ports-math.ceil(self.num_servers/self.num_switches)
+		n=self.num_switches
+		return [s-sum(1 for v in self.graph.adj[sw] if v<n) for sw in range(n)]
 
-				free_p=self.remover(r,free_p, ind_A,sw_A)
-				break
+	#pairs of distinct non-adjacent switches that both have free ports,
+	#which a correct wiring never leaves
+	def unmatched_pairs(self):
+		free=self.free_switch_ports()
+		pending=[sw for sw in range(self.num_switches) if free[sw]>0]
+		return [(a,b) for i,a in enumerate(pending) for b in pending[i+1:]
+		        if not self.graph.has_edge(a,b)]
 
-			if(free_p[ind_A] == 0):
-				free_p.pop(ind_A)
-				sw_to_conn.pop(ind_A)
-				remaining = remaining - 1
-				continue
+	#all-pairs switch distances, computed once with a batched BFS
+	#(see Graph.distance_layers)
+	def switch_distances(self):
+		if self.layers is None:
+			self.layers=self.graph.distance_layers(len(self.switches))
+		return self.layers
 
-			ind_B = random.randint(0, remaining - 1)
-			if ind_A == ind_B:
-				continue
+	#hop distance between two switches, -1 if they are not connected
+	def switch_distance(self,sw_a,sw_b):
+		bit=1<<sw_b.index
+		for d,layer in enumerate(self.switch_distances()):
+			if layer[sw_a.index]&bit:
+				return d
+		return -1
 
-			if(free_p[ind_B] == 0):
-				free_p.pop(ind_B)
-				sw_to_conn.pop(ind_B)
-				remaining = remaining - 1
-				continue
-			
-			sw_A = sw_to_conn[ind_A]
-			sw_B = sw_to_conn[ind_B]
-
-			if(not sw_A.is_neighbor(sw_B)):
-				sw_A.add_edge(sw_B)
-				free_p[ind_A] = free_p[ind_A] - 1
-				free_p[ind_B] = free_p[ind_B] - 1
-			elif sw_A.is_neighbor(sw_B) and remaining == 2:
-				break
+	#number of servers attached to every switch; servers left without a
+	#link by a topology mutation are not counted
+	def servers_per_switch(self):
+		count=array('l',[0])*len(self.switches)
+		adj=self.graph.adj
+		for server in self.servers.indices:
+			nbrs=adj[server]
+			if nbrs:
+				count[nbrs[0]]+=1
+		return count
 
+	#full distribution of the path length (in hops) between server pairs,
+	#as {hops: pairs}. Pairs of servers on disconnected switches are left out
+	def path_length_histogram(self):
 
-		self.connectServer(remaining_servers,r,serv_to_conn)
+		hist={}
+		layers=self.switch_distances()
+		per_switch=self.servers_per_switch()
 
-		return
+		#group the switches by number of attached servers
+		masks={}
+		for sw,c in enumerate(per_switch):
+			if c:
+				masks[c]=masks.get(c,0)|(1<<sw)
+
+		#servers behind the same switch are 2 hops apart
+		same=sum(c*(c-1)//2 for c in per_switch)
+		if same:
+			hist[2]=same
+
+		#every other pair is counted once from each side
+		for d in range(1,len(layers)):
+			layer=layers[d]
+			pairs=0
+			for sw,c in enumerate(per_switch):
+				if c and layer[sw]:
+					pairs+=c*sum(m*popcount(layer[sw]&mask) for m,mask in masks.items())
+			if pairs:
+				hist[d+2]=pairs//2
+
+		return hist
+
+	#Monte-Carlo estimate of path_length_histogram from a budget of samples
+	#random server pairs. Returns {hops: (pairs, low, high)} where low and
+	#high bound the estimate at the given confidence level (Wilson score).
+	#The pairs come from trees random source servers (about sqrt(samples)
+	#by default), each with its share of random destinations read off one
+	#BFS, so the cost is trees BFS plus O(samples). Pairs sharing a source
+	#are correlated, the interval uses the effective sample size measured
+	#between the trees. Pairs are drawn from rng, the generator of the
+	#instance by default
+	def sample_path_length_histogram(self,samples,confidence=0.95,rng=None,trees=None):
+
+		rng=rng or self.rng
+		n=len(self.servers)
+		total=n*(n-1)//2
+		server_sw=[self.server_switch(server).index for server in self.servers]
+		z=NormalDist().inv_cdf(0.5+confidence/2)
+		trees=min(samples,trees or max(2,math.isqrt(samples)))
+
+		#hits per tree, every pair is still uniform over the server pairs
+		counts=[]
+		for t in range(trees):
+			i=rng.randrange(n)
+			dist=self.graph.bfs(server_sw[i],len(self.switches))[0]
+			size=samples//trees+(t<samples%trees)
+			hits={}
+			for _ in range(size):
+				j=rng.randrange(n-1)
+				d=dist[server_sw[j+(j>=i)]]
+				if d>=0:
+					hits[d+2]=hits.get(d+2,0)+1
+			counts.append((size,hits))
+
+		hist={}
+		for hops in sorted(set().union(*(h for _,h in counts))):
+			p=sum(h.get(hops,0) for _,h in counts)/samples
+			#effective sample size from the spread of the per tree hit rates
+			m=samples
+			if trees>1:
+				var=trees/(trees-1)*sum((h.get(hops,0)-p*size)**2 for size,h in counts)/samples**2
+				if var>0:
+					m=min(samples,max(1.0,p*(1-p)/var))
+			centre=(p+z*z/(2*m))/(1+z*z/m)
+			margin=z*math.sqrt(p*(1-p)/m+z*z/(4*m*m))/(1+z*z/m)
+			hist[hops]=(p*total,max(0.0,centre-margin)*total,min(1.0,centre+margin)*total)
+		return hist
 
 	#method to calculare the path length between server pairs
 	def get_server_pairs(self):
-		
-		count=[0]*5
-		for i in range(0,len(self.servers)):
-			
-			sw_i=self.server_switch(self.servers[i])
-			dst_arr=self.shortest_path(sw_i)
-			for k in range(i+1,len(self.servers)):
-
-				sw_k=self.server_switch(self.servers[k])
-				hop=dst_arr[int(sw_k.id)]+2
-				if hop==6:
-					count[4]+=1
-				elif hop==5:
-					count[3]+=1
-				elif hop==4:
-					count[2]+=1
-				elif hop==3:
-					count[1]+=1
-				elif hop==2:
-					count[0]+=1
 
-		return count
+		hist=self.path_length_histogram()
+		return [hist.get(hops,0) for hops in range(2,7)]
 	
+	#number of distinct paths over every switch link, ranked, as in the
+	#path diversity figure of the Jellyfish paper: the k shortest paths
+	#between the switches of a random permutation of the servers
+	def link_path_counts(self,k=8,processes=None,rng=None):
+		rng=rng or self.rng
+		order=list(range(len(self.servers)))
+		rng.shuffle(order)
+		pairs=set()
+		for i,j in enumerate(order):
+			a=self.server_switch(self.servers[i]).index
+			b=self.server_switch(self.servers[j]).index
+			if a!=b:
+				pairs.add((a,b))
+		cache=KPathCache(self.graph,k)
+		try:
+			cache.precompute(pairs,processes)
+			counts=cache.link_path_counts(pairs)
+		finally:
+			cache.close()
+		return sorted(counts.values())
+
 	#method to get the switch which a server is connected to
 	def server_switch(self,server):
-		if server.edges[0].lnode==server:
-			return server.edges[0].rnode
-		else:
-			return server.edges[0].lnode
+		return self.graph.nodes[self.graph.adj[server.index][0]]
 	
+	#hop distance from the switch src to every switch
 	def shortest_path(self,src):
-		dst=[-1]*len(self.switches)
-		explored=[]
-		queue=[]
-		dst[int(src.id)]=0
-		queue.append(src)
-		queue.append(0)
-		while queue:
-			node=queue.pop(0)
-			dist=queue.pop(0)
-
-			if node not in explored:
-				for edge in node.edges:
-
-					if edge.lnode==node:
-						to_node=edge.rnode
-					else:
-						to_node=edge.lnode
-					
-					if to_node.type=="switch":
-						if to_node not in explored and dst[int(to_node.id)]==-1:
-							dst[int(to_node.id)]=dist+1				
-							queue.append(to_node)
-							queue.append(dist+1)
-					
-				explored.append(node)
-			
-		return dst	
+		dst,prec=self.graph.bfs(src.index,len(self.switches))
+		return list(dst)
 
 	#returns also the path
 	def shortest_path2(self,src):
-		dst=[-1]*len(self.switches)
-		prec=[None]*len(self.switches)
-		explored=[]
-		queue=[]
-		dst[int(src.id)]=0
-		queue.append(src)
-		queue.append(0)
-		while queue :
-			node=queue.pop(0)
-			dist=queue.pop(0)
-
-			if node not in explored:
-				for edge in node.edges:
-
-					if edge.lnode==node:
-						to_node=edge.rnode
-					else:
-						to_node=edge.lnode
-					
-					if to_node.type=="switch":
-						if dst[int(to_node.id)]==-1:
-							dst[int(to_node.id)]=dist+1
-							prec[int(to_node.id)]=node.id				
-							queue.append(to_node)
-							queue.append(dist+1)
-					
-				explored.append(node)
-
-		return dst,prec	
+		dst,prec=self.graph.bfs(src.index,len(self.switches))
+		ids=self.graph.ids
+		return list(dst),[ids[p] if p>=0 else None for p in prec]
 	
 
 class Fattree:
 
 	def __init__(self, num_ports):
+		self.graph = Graph()
 		self.servers = []
 		self.switches = []
 		self.core_switches=0
@@ -299,32 +962,36 @@ class Fattree:
 	def generateSwitches(self):
 
 		#Core switches
+		ids=[]
 		for i in range(0,int(self.core_switches)):
-			id="10.1."+str(self.num_pod)+"."+str(i)
-			node=Node(id,type="core_switch")
-			self.switches.append(node)
+			ids.append("10.1."+str(self.num_pod)+"."+str(i))
+		core=self.graph.add_nodes(ids,"core_switch")
 
 		#aggregation and edge switches for pod
+		ids=[]
 		for p in range(0,int(self.num_pod)):					#pod
 			base_id="10."+str(p)+"."			
 			for s in range(0,int(self.num_pod)):				#switch
-				id=base_id+str(s)+".1"
-				node=Node(id,type="switch")
-				self.switches.append(node)
+				ids.append(base_id+str(s)+".1")
+		pods=self.graph.add_nodes(ids,"switch")
+		self.switches=NodeList(self.graph,range(core.start,pods.stop))
 
 	def generateServers(self):
 		
+		ids=[]
 		for p in range(0,self.num_pod):					#pod
 			base_id="10."+str(p)+"."
 			for s in range(0,int(self.num_pod/2)):				#switch
 				base_id_=base_id+str(s)+"."
 				for i in range(2,2+int(self.num_pod/2)):
-					id=base_id_+str(i)
-					#print(id)
-					node=Node(id,type="server")
-					self.servers.append(node)
+					ids.append(base_id_+str(i))
+		self.servers=NodeList(self.graph,self.graph.add_nodes(ids,"server"))
 
 	def connect_network(self):
+		graph=self.graph
+		switches=self.switches.indices
+		servers=self.servers.indices
+
 		#connect edge switches to servers
 		for p in range(0,self.num_pod):
 			
@@ -333,35 +1000,41 @@ class Fattree:
 				
 				for i in range(0,int(self.switches_pod/2)):
 					os=p*self.core_switches+s*int(self.switches_pod/2)+i		#offset to find server
-					switch=self.switches[int(offset)]
-					self.servers[int(os)].add_edge(switch)
+					graph.add_edge(servers[int(os)],switches[int(offset)])
 
 		#connect edge switches to aggregation switches
 		for p in range(0,self.num_pod):
 
 			for s in range(0,int(self.switches_pod/2)):
 				offset=self.core_switches+(self.num_pod*p)+s #offset to find switch
-				switch=self.switches[int(offset)]
+				switch=switches[int(offset)]
 
 				for i in range(int(self.switches_pod/2),int(self.switches_pod)):
 					os=self.core_switches+(self.num_pod*p)+i
-					ag_switch=self.switches[int(os)]
-					switch.add_edge(ag_switch)
+					graph.add_edge(switch,switches[int(os)])
 
 		#connect aggregation to core
 		for p in range(0,self.num_pod):
 			core=0
 			for s in range(int(self.num_pod/2),int(self.num_pod)):
 				offset=self.core_switches+(self.num_pod*p)+s #offset to find switch
-				switch=self.switches[int(offset)]
+				switch=switches[int(offset)]
 				for i in range(core,core+int(self.num_pod/2)):
-					switch.add_edge(self.switches[i])
+					graph.add_edge(switch,switches[i])
 				
 				core=core+int(self.num_pod/2)
+		graph.compact()
 					
 	def generate(self, num_ports):
-				
-		# TODO: code for generating the fat-tree topology
+
+		self.set_dimensions(num_ports)
+		self.generateSwitches()
+		self.generateServers()
+		self.connect_network()
+
+	#number of switches and servers of a fat-tree of k = num_ports
+	def set_dimensions(self, num_ports):
+
 		# switches
 		k2=math.pow(num_ports,2)
 		self.num_switches=int(5*k2/4)
@@ -375,33 +1048,372 @@ class Fattree:
 		
 		self.switches_pod=(self.num_switches-self.core_switches)/self.num_pod
 
-		self.generateSwitches()
-		self.generateServers()
-		self.connect_network()
+	#role ("core", "aggregation" or "edge"), pod (None for the core) and
+	#position within its layer (within the pod for pod switches) of the
+	#switch at the given node index
+	def switch_role(self, index):
+		k=self.num_pod
+		core=int(self.core_switches)
+		if index<core:
+			return "core",None,index
+		pod,s=divmod(index-core,k)
+		if s<k//2:
+			return "edge",pod,s
+		return "aggregation",pod,s-k//2
+
+	#name of a switch in the mininet network: layer digit (1 core,
+	#2 aggregation, 3 edge) followed by its number in the layer. Mininet
+	#derives the datapath id from the digits of the name
+	def switch_name(self, index):
+		role,pod,pos=self.switch_role(index)
+		if role=="core":
+			return "1"+str(pos)
+		layer="2" if role=="aggregation" else "3"
+		return layer+str(pod*(self.num_pod//2)+pos)
+
+	def switch_dpid(self, index):
+		return int(self.switch_name(index))
+
+	#map of datapath id to switch_role for all the switches
+	def dpid_map(self):
+		return {self.switch_dpid(sw.index): self.switch_role(sw.index) for sw in self.switches}
+
+	#Port numbering of the mininet network. Core switch ports go to the
+	#pods in order; aggregation and edge switches have their uplinks
+	#first, then their downlinks
+	def core_port(self, pod):
+		return pod+1
+
+	#port of an aggregation switch toward the i-th core switch of its group
+	def aggregation_up_port(self, i):
+		return i+1
+
+	#port of an aggregation switch toward the edge switch at position edge
+	def aggregation_down_port(self, edge):
+		return self.num_pod//2+edge+1
+
+	#port of an edge switch toward the aggregation switch at position aggregation
+	def edge_up_port(self, aggregation):
+		return aggregation+1
+
+	#port of an edge switch toward its server with host id host_id (2..k/2+1)
+	def edge_host_port(self, host_id):
+		return self.num_pod//2+host_id-1
+
+	#MAC address of every server as {ip: mac}. Mininet with autoSetMacs
+	#numbers the hosts from 1 in the order of self.servers
+	def server_macs(self):
+		macs={}
+		for position,server in enumerate(self.servers):
+			n=position+1
+			macs[server.id]=":".join("%02x" % ((n>>(8*i)) & 0xff) for i in range(5,-1,-1))
+		return macs
+
+	#full distribution of the path length (in hops) between server pairs,
+	#as {hops: pairs}, computed in closed form from k
+	def path_length_histogram(self):
+
+		k=self.num_pod
+		servers_edge=k//2
+		servers_pod=servers_edge*k//2
+		edge=k*k//2
+		same_switch=edge*servers_edge*(servers_edge-1)//2
+		same_pod=k*servers_pod*(servers_pod-1)//2-same_switch
+		other=self.num_servers*(self.num_servers-1)//2-same_switch-same_pod
+
+		hist={}
+		for hops,pairs in ((2,same_switch),(4,same_pod),(6,other)):
+			if pairs:
+				hist[hops]=pairs
+		return hist
 
 	#method which return the path length between all possible server pairs
 	def get_server_pairs(self):
 
-		count=[0]*3
-		for i in range(0,len(self.servers)):
-			
-			s=self.servers[i]
-			#recover pod
-			id=s.id
-			splitted=id.split(".")
-			pod_n_s=splitted[1]
-			switch_n_s=splitted[2]
-
-			for j in range(i+1,len(self.servers)):
-				s2=self.servers[j]
-				id=s2.id
-				splitted=id.split(".")
-				pod_n_s2=splitted[1]
-				switch_n_s2=splitted[2]
-				if (switch_n_s==switch_n_s2) and (pod_n_s==pod_n_s2):
-					count[0]+=1
-				elif (pod_n_s==pod_n_s2):
-					count[1]+=1
-				else:
-					count[2]+=1
-		return count
+		hist=self.path_length_histogram()
+		return [hist.get(2,0),hist.get(4,0),hist.get(6,0)]
+
+
+# Binary topology files
+#
+# A file is a fixed header followed by flat little-endian arrays:
+#   header   magic, version, kind, node/link/switch/server counts and
+#            four topology parameters (Jellyfish: servers, switches,
+#            ports, unmatched ports; Fattree: k)
+#   types    uint8 per node, an index into NODE_TYPES
+#   ids      uint32 offsets (nodes + 1) into a utf-8 blob
+#   adj      uint32 CSR offsets (nodes + 1) and targets
+#   links    uint32 (lnode, rnode) pairs
+#   switches uint32 node indices of Jellyfish/Fattree.switches
+#   servers  uint32 node indices of Jellyfish/Fattree.servers
+# Sections are padded to 8 bytes. load() memory-maps the file and builds
+# the Python objects of a node (id, neighbour array, Node view) only when
+# it is first accessed.
+
+TOPO_MAGIC = b"TOPO"
+TOPO_VERSION = 1
+TOPO_HEADER = struct.Struct("<4sHHIIII4I")
+NODE_TYPES = ("switch", "core_switch", "server")
+KINDS = ("jellyfish", "fattree")
+
+# List that builds item i with make(i) the first time it is accessed
+class LazyList:
+	def __init__(self, n, make):
+		self.n = n
+		self.items = {}
+		self.make = make
+
+	def __len__(self):
+		return self.n
+
+	def __getitem__(self, i):
+		if i < 0:
+			i += self.n
+		item = self.items.get(i)
+		if item is None:
+			if not 0 <= i < self.n:
+				raise IndexError("list index out of range")
+			item = self.items[i] = self.make(i)
+		return item
+
+	def __iter__(self):
+		for i in range(self.n):
+			yield self[i]
+
+	def append(self, item):
+		self.extend((item,))
+
+	def extend(self, items):
+		for item in items:
+			if item is not None:
+				self.items[self.n] = item
+			self.n += 1
+
+# Node types as one code per node, an index into the type names
+class TypeList(Sequence):
+	def __init__(self, codes=None, names=NODE_TYPES):
+		self.codes = bytearray() if codes is None else codes
+		self.names = list(names)
+
+	def __len__(self):
+		return len(self.codes)
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return [self.names[c] for c in self.codes[i]]
+		return self.names[self.codes[i]]
+
+	def __iter__(self):
+		names = self.names
+		for c in self.codes:
+			yield names[c]
+
+	def append(self, type):
+		self.extend((type,))
+
+	def extend(self, types):
+		if not isinstance(self.codes, bytearray):
+			self.codes = bytearray(self.codes)
+		names = self.names
+		for type in types:
+			if type not in names:
+				names.append(sys.intern(type))
+			self.codes.append(names.index(type))
+
+# Strings packed one after the other in a bytes-like blob, the string i
+# being blob[offsets[i]:offsets[i + 1]]; they are decoded on access
+class StringList(Sequence):
+	def __init__(self, offsets=None, blob=None):
+		self.offsets = array('I', [0]) if offsets is None else offsets
+		self.blob = bytearray() if blob is None else blob
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return [self[j] for j in range(*i.indices(len(self)))]
+		if i < 0:
+			i += len(self)
+		return str(self.blob[self.offsets[i]:self.offsets[i + 1]], "utf-8")
+
+	def append(self, string):
+		self.extend((string,))
+
+	def extend(self, strings):
+		if not isinstance(self.blob, bytearray):
+			self.offsets = array('I', self.offsets)
+			self.blob = bytearray(self.blob)
+		blob, offsets = self.blob, self.offsets
+		for string in strings:
+			blob.extend(string.encode("utf-8"))
+			offsets.append(len(blob))
+
+# Neighbours of every node of a Graph, as graph.adj[u]
+class Adjacency(Sequence):
+	def __init__(self, graph):
+		self.graph = graph
+
+	def __len__(self):
+		return len(self.graph)
+
+	def __getitem__(self, u):
+		return self.graph.neighbors(u)
+
+	def __iter__(self):
+		for u in range(len(self.graph)):
+			yield self.graph.neighbors(u)
+
+# Graph whose nodes and links live in a memory-mapped topology file until
+# they are accessed. It can be mutated like any other Graph; the CSR
+# arrays are served from the file until a mutation is compacted, and the
+# orientation flags are only worked out of the link list when needed
+class MappedGraph(Graph):
+	def __init__(self, buf, types, id_offsets, id_blob, adj_offsets, adj_targets, edges):
+		self.buf = buf
+		self.ids = StringList(id_offsets, id_blob)
+		self.types = TypeList(types)
+		self.nodes = LazyList(len(types), lambda i: Node(self, i))
+		self.adj = Adjacency(self)
+		self.offsets = adj_offsets
+		self.targets = adj_targets
+		self.edges = edges
+		self._flags = None
+		self.overflow = {}
+		self.keys = None
+		self.failed = set()
+		self.removed = set()
+		self.num_links = len(edges) // 2
+		self.subscribers = []
+
+	@property
+	def flags(self):
+		if self._flags is None:
+			offsets, targets, edges = self.offsets, self.targets, self.edges
+			flags = bytearray(len(targets))
+			for j in range(0, len(edges), 2):
+				u, v = edges[j], edges[j + 1]
+				for i in range(offsets[u], offsets[u + 1]):
+					if targets[i] == v:
+						flags[i] = 1
+						break
+			self._flags = flags
+		return self._flags
+
+	@flags.setter
+	def flags(self, flags):
+		self._flags = flags
+
+	# Until the flags are worked out the file is untouched, and its link
+	# list gives the keys directly
+	def link_keys(self):
+		if self.keys is None and self._flags is None:
+			edges = self.edges
+			self.keys = set((edges[j] << 32) | edges[j + 1] for j in range(0, len(edges), 2))
+		return Graph.link_keys(self)
+
+# Nodes of a graph selected by an index array, as a read-only list
+class NodeList(Sequence):
+	def __init__(self, graph, indices):
+		self.graph = graph
+		self.indices = indices
+
+	def __len__(self):
+		return len(self.indices)
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return [self.graph.nodes[u] for u in self.indices[i]]
+		return self.graph.nodes[self.indices[i]]
+
+def _pad(out):
+	out.write(bytes(-out.tell() % 8))
+
+def _write_array(out, typecode, values):
+	data = array(typecode, values)
+	if sys.byteorder != "little":
+		data.byteswap()
+	out.write(data.tobytes())
+	_pad(out)
+
+#save a Jellyfish or Fattree topology to a binary file
+def save(topology, path):
+	graph = topology.graph
+	n = len(graph)
+	if isinstance(topology, Jellyfish):
+		kind = 0
+		params = (topology.num_servers, topology.num_switches,
+		          topology.num_ports, topology.unmatched_ports)
+	else:
+		kind = 1
+		params = (topology.num_pod, 0, 0, 0)
+
+	ids = [graph.ids[u].encode("utf-8") for u in range(n)]
+	id_offsets = [0]
+	for id in ids:
+		id_offsets.append(id_offsets[-1] + len(id))
+	offsets, targets = graph.csr()
+	edges = []
+	for key in graph.links:
+		edges.append(key >> 32)
+		edges.append(key & 0xffffffff)
+
+	with open(path, "wb") as out:
+		out.write(TOPO_HEADER.pack(TOPO_MAGIC, TOPO_VERSION, kind, n,
+		                           graph.num_links, len(topology.switches),
+		                           len(topology.servers), *params))
+		_pad(out)
+		out.write(bytes(NODE_TYPES.index(graph.types[u]) for u in range(n)))
+		_pad(out)
+		_write_array(out, 'I', id_offsets)
+		out.write(b"".join(ids))
+		_pad(out)
+		_write_array(out, 'I', offsets)
+		_write_array(out, 'I', targets)
+		_write_array(out, 'I', edges)
+		_write_array(out, 'I', [node.index for node in topology.switches])
+		_write_array(out, 'I', [node.index for node in topology.servers])
+
+#load a topology saved with save(); the file is memory-mapped and stays
+#open as long as the returned topology uses it
+def load(path):
+	if sys.byteorder != "little":
+		raise ValueError("topology files can only be mapped on little-endian hosts")
+	with open(path, "rb") as f:
+		buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	view = memoryview(buf)
+	magic, version, kind, n, num_links, num_sw, num_sv, *params = TOPO_HEADER.unpack_from(buf)
+	if magic != TOPO_MAGIC or version != TOPO_VERSION:
+		raise ValueError("%s is not a version %d topology file" % (path, TOPO_VERSION))
+
+	pos = [TOPO_HEADER.size]
+	def section(nbytes, fmt="B"):
+		start = pos[0]
+		pos[0] = start + nbytes + (-nbytes % 8)
+		return view[start:start + nbytes].cast(fmt)
+
+	types = section(n)
+	id_offsets = section(4 * (n + 1), "I")
+	id_blob = section(id_offsets[n])
+	adj_offsets = section(4 * (n + 1), "I")
+	adj_targets = section(4 * adj_offsets[n], "I")
+	edges = section(8 * num_links, "I")
+	switches = section(4 * num_sw, "I")
+	servers = section(4 * num_sv, "I")
+	graph = MappedGraph(buf, types, id_offsets, id_blob, adj_offsets, adj_targets, edges)
+
+	if KINDS[kind] == "jellyfish":
+		topology = Jellyfish.__new__(Jellyfish)
+		topology.rng = random
+		(topology.num_servers, topology.num_switches,
+		 topology.num_ports, topology.unmatched_ports) = params
+		topology.layers = None
+		graph.subscribe(topology.on_change)
+	else:
+		topology = Fattree.__new__(Fattree)
+		topology.num_pod = params[0]
+		topology.set_dimensions(params[0])
+	topology.graph = graph
+	topology.switches = NodeList(graph, switches)
+	topology.servers = NodeList(graph, servers)
+	return topology